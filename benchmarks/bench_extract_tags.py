@@ -0,0 +1,99 @@
+"""Determinism and throughput of extract_tags on 1MB inputs.
+
+Checks that tags never exceed MAX_TAGS and are identical across processes
+with different PYTHONHASHSEED values (set iteration order changes with the
+seed), then reports MB/s on an input whose tags all appear early (the scan
+can stop at the cap) and on one with no vocabulary terms (a full scan), next
+to the set-based extractor it replaced. Exits non-zero if a check fails.
+
+    python benchmarks/bench_extract_tags.py
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List
+
+from common import cbm
+
+def legacy_extract_tags(code: str, description: str) -> List[str]:
+    """The original extractor, kept as the baseline"""
+    tags = set()
+    desc_words = re.findall(r'\b\w+\b', description.lower())
+    for word in desc_words:
+        if word in cbm.TAG_VOCABULARY:
+            tags.add(word)
+    code_words = re.findall(r'\b\w+\b', code.lower())
+    for word in code_words:
+        if word in cbm.TAG_VOCABULARY:
+            tags.add(word)
+    if 'function' in code.lower() or 'def ' in code:
+        tags.add('function')
+    if 'class ' in code:
+        tags.add('class')
+    if 'async' in code or 'await' in code:
+        tags.add('async')
+    if 'export' in code:
+        tags.add('module')
+    return list(tags)[:10]
+
+def inputs(size: int) -> Dict[str, str]:
+    """1MB-scale inputs: vocabulary terms up front, and none at all"""
+    early = ("export async function fetchUser(api, user) {\n"
+             "  const json = await http.get(api + '/user'); // parser, validator, helper, table, list, menu\n"
+             "}\n")
+    filler = "let alpha_beta = gamma_delta(epsilon, zeta_eta) + theta_iota * kappa;\n"
+    return {
+        'early exit': early + filler * ((size - len(early)) // len(filler)),
+        'no match': filler * (size // len(filler)),
+    }
+
+def mb_per_second(extract: Callable[[str, str], List[str]], code: str, min_seconds: float = 0.5) -> float:
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        extract(code, 'fetch helper')
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return calls * len(code) / elapsed / 1e6
+
+def tags_by_input(size: int) -> Dict[str, List[str]]:
+    return {name: cbm.extract_tags(code, 'fetch helper') for name, code in inputs(size).items()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1_000_000, help="input size in characters")
+    parser.add_argument('--print-tags', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.print_tags:
+        print(json.dumps(tags_by_input(args.size)))
+        return
+
+    failures = []
+    expected = tags_by_input(args.size)
+    for name, tags in expected.items():
+        print(f"{name:10} tags: {', '.join(tags) or '-'}")
+        if len(tags) > cbm.MAX_TAGS:
+            failures.append(f"{name}: {len(tags)} tags, more than MAX_TAGS={cbm.MAX_TAGS}")
+    for seed in ('1', '2', '3'):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--print-tags', '--size', str(args.size)],
+            env={**os.environ, 'PYTHONHASHSEED': seed}, capture_output=True, text=True, check=True).stdout
+        if json.loads(output) != expected:
+            failures.append(f"tags differ with PYTHONHASHSEED={seed}")
+
+    for name, code in inputs(args.size).items():
+        for label, extract in (('legacy', legacy_extract_tags), ('current', cbm.extract_tags)):
+            print(f"{name:10} {label:8} {mb_per_second(extract, code):8.1f} MB/s")
+    if failures:
+        for failure in failures:
+            print(failure, file=sys.stderr)
+        sys.exit(1)
+    print("tags are capped and identical across hash seeds")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Accuracy and speed of detect_language on the labelled corpus.
+
+Compares the current detector with the keyword-chain detector it replaced,
+reporting accuracy and misses on each corpus (the tricky samples and the
+realistic short pastes) and time per call on all snippets and on a 1MB
+input. Exits non-zero if either corpus falls below --min-accuracy.
+
+    python benchmarks/bench_language_detection.py
+"""
+import argparse
+import sys
+import time
+from typing import Callable
+
+from common import cbm
+from language_corpus import REALISTIC_SAMPLES, SAMPLES
+
+def legacy_detect_language(code: str) -> str:
+    """The original first-match-wins detector, kept as the baseline"""
+    code_lower = code.lower().strip()
+    if any(keyword in code for keyword in ['import {', 'export function', 'interface ', ': string', ': number']):
+        if 'interface ' in code or ': string' in code or ': number' in code:
+            return 'typescript'
+        return 'javascript'
+    if any(keyword in code for keyword in ['def ', 'import ', 'from ', 'class ', '__init__']):
+        return 'python'
+    if any(keyword in code_lower for keyword in ['select ', 'insert ', 'update ', 'delete ', 'create table']):
+        return 'sql'
+    if '{' in code and '}' in code and (':' in code) and any(prop in code_lower for prop in ['color:', 'margin:', 'padding:', 'display:']):
+        return 'css'
+    if '<' in code and '>' in code and any(tag in code_lower for tag in ['<div', '<span', '<html', '<body']):
+        return 'html'
+    if any(keyword in code for keyword in ['public class', 'private ', 'public static void main']):
+        return 'java'
+    if any(keyword in code for keyword in ['package main', 'func ', 'import (']):
+        return 'go'
+    if any(keyword in code for keyword in ['fn ', 'let mut', 'use std::']):
+        return 'rust'
+    return 'unknown'
+
+def time_per_call(detect: Callable[[str], str], inputs: list, min_seconds: float = 0.5) -> float:
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        for code in inputs:
+            detect(code)
+        calls += len(inputs)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return elapsed / calls
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--min-accuracy', type=float, default=0.95)
+    args = parser.parse_args()
+
+    large = [(SAMPLES[0][1] * (1_000_000 // len(SAMPLES[0][1])))]
+    corpora = {'tricky': SAMPLES, 'realistic': REALISTIC_SAMPLES}
+    snippets = [code for samples in corpora.values() for _, code in samples]
+    low = []
+    for name, detect in (('legacy', legacy_detect_language), ('current', cbm.detect_language)):
+        print(f"{name:8} {time_per_call(detect, snippets) * 1e6:.1f}us/snippet, "
+              f"{time_per_call(detect, large) * 1e3:.2f}ms/1MB input")
+        for corpus, samples in corpora.items():
+            misses = [(language, detected, code) for language, code in samples
+                      if (detected := detect(code)) != language]
+            accuracy = 1 - len(misses) / len(samples)
+            print(f"  {corpus:10} accuracy {accuracy:.1%} ({len(samples) - len(misses)}/{len(samples)})")
+            for language, detected, code in misses:
+                print(f"             expected {language}, got {detected}: {code.splitlines()[0][:60]!r}")
+            if name == 'current' and accuracy < args.min_accuracy:
+                low.append(f"{corpus} accuracy {accuracy:.1%} is below {args.min_accuracy:.1%}")
+    if low:
+        print('\n'.join(low), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
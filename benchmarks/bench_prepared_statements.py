@@ -0,0 +1,86 @@
+"""QPS of registered statements through the statement cache versus unprepared queries.
+
+Migrates and seeds the database, then runs hot read statements from
+--concurrency tasks for --seconds each, two ways: on the app's pool, where
+asyncpg's per-connection statement cache prepares each shape once, and on a
+pool with statement_cache_size=0, so every call is parsed and planned again.
+
+    DATABASE_URL=postgresql://localhost/scratch python benchmarks/bench_prepared_statements.py
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, List
+
+import asyncpg
+
+from check_query_plans import sample_params
+from common import cbm, seed_blocks
+
+STATEMENT_NAMES = (
+    'block_by_id',
+    'blocks_by_ids:summary',
+    'browse:summary',
+    'browse_after:summary',
+    'search:fulltext:all:first:summary',
+    'search:fulltext:language:after:summary',
+)
+
+async def measure(pool: asyncpg.Pool, run: Callable[[Any, str, List[Any]], Awaitable[Any]],
+                  params: dict, args: argparse.Namespace) -> float:
+    """Queries per second of one statement shape after another, across all tasks"""
+    deadline = time.perf_counter() + args.seconds
+    counts = []
+
+    async def worker():
+        done = 0
+        while time.perf_counter() < deadline:
+            name = STATEMENT_NAMES[done % len(STATEMENT_NAMES)]
+            async with pool.acquire() as conn:
+                await run(conn, name, params[name])
+            done += 1
+        counts.append(done)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return sum(counts) / (time.perf_counter() - started)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000, help="seed code_blocks up to this many rows")
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    await cbm.run_migrations()
+    conn = await asyncpg.connect(cbm.DATABASE_URL)
+    try:
+        await seed_blocks(conn, args.rows)
+        row = await conn.fetchrow("SELECT id, created_at FROM code_blocks ORDER BY created_at DESC, id DESC OFFSET 100 LIMIT 1")
+        block_ids = [r['id'] for r in await conn.fetch("SELECT id FROM code_blocks LIMIT 20")]
+    finally:
+        await conn.close()
+    params = {name: sample_params(name, row['id'], row['created_at'], block_ids) for name in STATEMENT_NAMES}
+
+    async def run(conn, name, values):
+        return await conn.fetch(cbm.STATEMENTS[name], *values)
+
+    variants = (
+        ('statement cache', lambda: cbm.create_app_pool(cbm.DATABASE_URL)),
+        ('unprepared', lambda: asyncpg.create_pool(
+            cbm.DATABASE_URL, min_size=args.concurrency, max_size=args.concurrency, statement_cache_size=0,
+            server_settings={'pg_trgm.word_similarity_threshold': str(cbm.FUZZY_THRESHOLD)})),
+    )
+    print(f"{args.concurrency} tasks, {len(STATEMENT_NAMES)} statement shapes in turn, {args.seconds}s each")
+    rates = {}
+    for name, create_pool in variants:
+        pool = await create_pool()
+        try:
+            rates[name] = await measure(pool, run, params, args)
+        finally:
+            await pool.close()
+        print(f"{name:16} {rates[name]:9,.0f} queries/s")
+    print(f"statement cache vs unprepared: {rates['statement cache'] / rates['unprepared']:.2f}x")
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+"""Rows per second of the shared row mapping (block_row_to_dict, encode_block_rows).
+
+Maps and encodes 10, 100 and 1000-row results of synthetic rows in the full
+and summary views. Rows are dicts shaped like the asyncpg records the
+endpoints see, so no database is needed. Exits non-zero if any case falls
+below --min-rows-per-sec, to catch regressions.
+
+    python benchmarks/bench_row_mapping.py --min-rows-per-sec 100000
+"""
+import argparse
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+from common import cbm, sample_rows
+
+SIZES = (10, 100, 1000)
+
+def rows_per_second(func: Callable[[List[Dict[str, Any]]], Any], rows: List[Dict[str, Any]],
+                    min_seconds: float = 0.5) -> float:
+    mapped = 0
+    started = time.perf_counter()
+    while True:
+        func(rows)
+        mapped += len(rows)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return mapped / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--code-chars', type=int, default=2000)
+    parser.add_argument('--min-rows-per-sec', type=float, default=0)
+    args = parser.parse_args()
+
+    full = sample_rows(max(SIZES), args.code_chars)
+    summary = [{key: value for key, value in row.items() if key != 'code'} for row in full]
+    cases = (
+        ('block_row_to_dict full', full, lambda rows: [cbm.block_row_to_dict(row) for row in rows]),
+        ('block_row_to_dict summary', summary, lambda rows: [cbm.block_row_to_dict(row, 'preview') for row in rows]),
+        ('encode_block_rows full', full, lambda rows: cbm.encode_block_rows(rows)),
+        ('encode_block_rows summary', summary, lambda rows: cbm.encode_block_rows(rows, 'summary')),
+    )
+    slow = []
+    for name, rows, func in cases:
+        for size in SIZES:
+            rate = rows_per_second(func, rows[:size])
+            print(f"{name:26} {size:5} rows  {rate:12,.0f} rows/s")
+            if rate < args.min_rows_per_sec:
+                slow.append(f"{name} at {size} rows")
+    if slow:
+        print(f"below {args.min_rows_per_sec:,.0f} rows/s: {', '.join(slow)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Query latency of the in-memory BM25 index (SEARCH_BACKEND=memory).
+
+Builds an index of --docs synthetic blocks and times common-term,
+multi-term and language-filtered queries, including a second page.
+
+    python benchmarks/bench_search_index.py --docs 200000
+"""
+import argparse
+import random
+import time
+import uuid
+
+from common import cbm, percentile, synthetic_block
+
+QUERIES = [('function', None), ('parse json', None), ('parse json', 'python'),
+           ('cache retry token', None), ('return', 'go')]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--docs', type=int, default=200_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    index = cbm.InvertedIndex()
+    started = time.perf_counter()
+    for n in range(args.docs):
+        block = synthetic_block(n, rng)
+        index.add(uuid.UUID(int=rng.getrandbits(128)), block['code'], block['description'],
+                  block['language'], block['tags'])
+    print(f"indexed {args.docs} blocks in {time.perf_counter() - started:.1f}s")
+
+    for query, language in QUERIES:
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            hits = index.search(query, language, 20)
+            if hits:
+                index.search(query, language, 20, (hits[-1][1], cbm._cursor_id(hits[-1][0])))
+            timings.append((time.perf_counter() - started) / 2)
+        print(f"{query!r:22} language={language or '-':7} p50 {percentile(timings, 50) * 1e3:6.2f}ms  "
+              f"p99 {percentile(timings, 99) * 1e3:6.2f}ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""CPU per list response: encode_block_rows versus the pydantic path it replaced.
+
+The old /api/search and /api/blocks built a CodeBlockResponse per row and
+let FastAPI validate the list against response_model, run jsonable_encoder
+and render a JSONResponse. The new path encodes rows straight to bytes.
+Both are timed on --rows synthetic rows with --code-chars of code each.
+
+    python benchmarks/bench_serialization.py --rows 50 --code-chars 2000
+"""
+import argparse
+import json
+import time
+from typing import Any, Callable, Dict, List
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from common import cbm, sample_rows
+
+RESPONSE_ADAPTER = TypeAdapter(List[cbm.CodeBlockResponse])
+
+def pydantic_response(rows: List[Dict[str, Any]]) -> bytes:
+    """The original per-row model, response_model validation and jsonable_encoder"""
+    blocks = [cbm.CodeBlockResponse(
+        id=str(row['id']),
+        hash=row['hash'],
+        code=row['code'],
+        description=row['description'],
+        language=row['language'],
+        tags=list(row['tags']),
+        usage_count=row['usage_count'],
+        success_rate=float(row['success_rate']),
+        created_at=row['created_at'].isoformat(),
+    ) for row in rows]
+    validated = RESPONSE_ADAPTER.validate_python([block.model_dump() for block in blocks])
+    return JSONResponse(jsonable_encoder(validated)).body
+
+def encoded_response(rows: List[Dict[str, Any]]) -> bytes:
+    return cbm.encode_block_rows(rows)
+
+def cpu_per_call(encode: Callable[[List[Dict[str, Any]]], bytes], rows: List[Dict[str, Any]],
+                 min_seconds: float = 1.0) -> float:
+    calls = 0
+    started = time.process_time()
+    while True:
+        encode(rows)
+        calls += 1
+        elapsed = time.process_time() - started
+        if elapsed >= min_seconds:
+            return elapsed / calls
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50)
+    parser.add_argument('--code-chars', type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = sample_rows(args.rows, args.code_chars)
+    if json.loads(pydantic_response(rows)) != json.loads(encoded_response(rows)):
+        raise SystemExit("encode_block_rows output differs from the pydantic response")
+
+    print(f"{args.rows} rows, {args.code_chars} chars of code each, orjson {'on' if cbm.orjson else 'off'}")
+    timings = {}
+    for name, encode in (('pydantic', pydantic_response), ('encode_block_rows', encoded_response)):
+        timings[name] = cpu_per_call(encode, rows)
+        print(f"{name:18} {timings[name] * 1e6:9.1f}us CPU per response")
+    saved = timings['pydantic'] - timings['encode_block_rows']
+    print(f"saved {saved * 1e6:.1f}us per response ({timings['pydantic'] / timings['encode_block_rows']:.1f}x)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Check that every registered statement reads code_blocks through an index.
+
+Migrates the database, seeds code_blocks up to --rows synthetic blocks
+(default 1M), then EXPLAINs each statement in the registry both as a custom
+plan (with representative parameters) and as the generic plan a cached
+prepared statement may switch to. Exits non-zero if any plan sequentially
+scans code_blocks. mode=ilike is exempt: it is the legacy unindexed scan.
+
+    DATABASE_URL=postgresql://localhost/scratch python benchmarks/check_query_plans.py
+"""
+import argparse
+import asyncio
+import json
+import sys
+from typing import Any, Iterator, List, Tuple
+
+import asyncpg
+
+from common import cbm, seed_blocks
+
+# Statements allowed to scan code_blocks sequentially
+EXEMPT_PREFIXES = ('search:ilike:',)
+
+SEARCH_TERMS = {'fulltext': 'parse json', 'substring': 'parse_json', 'fuzzy': 'parse_jsn', 'ilike': 'parse'}
+
+def plan_nodes(node: dict) -> Iterator[dict]:
+    yield node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child)
+
+def sample_params(name: str, block_id: Any, created_at: Any, block_ids: List[Any]) -> List[Any]:
+    """Representative parameters for a registered statement"""
+    kind, _, rest = name.partition(':')
+    if kind == 'search':
+        mode, language, after, _view = rest.split(':')
+        params = [SEARCH_TERMS[mode]]
+        if language == 'language':
+            params.append('python')
+        if after == 'after':
+            params.extend([0.05, block_id])
+        return params + [20]
+    if kind == 'hybrid_text':
+        return ['parse json'] + (['python'] if rest == 'language' else [])
+    if kind in ('popularity_by_ids', 'blocks_by_ids'):
+        return [block_ids]
+    if kind == 'browse':
+        return [20]
+    if kind == 'browse_after':
+        return [created_at, block_id, 20]
+    if kind in ('block_by_id', 'count_reuse'):
+        return [block_id]
+    if kind == 'upsert_block':
+        return ['0' * 32, 'x = 1', 'plan check', 'python', ['check'], 0, 1.0, None, None]
+    return []
+
+async def explain(conn: asyncpg.Connection, sql: str, params: List[Any], generic: bool) -> dict:
+    """The plan of sql, custom for params or generic"""
+    if not generic:
+        # EXPLAIN plans bound parameters as constants, which is the custom plan
+        return json.loads(await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *params))[0]['Plan']
+    # Only a prepared statement has a generic plan; forced, it ignores the values
+    await conn.execute(f"PREPARE plan_check AS {sql}")
+    try:
+        args = f"({', '.join(['NULL'] * len(params))})" if params else ""
+        return json.loads(await conn.fetchval(f"EXPLAIN (FORMAT JSON) EXECUTE plan_check{args}"))[0]['Plan']
+    finally:
+        await conn.execute("DEALLOCATE plan_check")
+
+async def check_plans(conn: asyncpg.Connection, plan_cache_mode: str) -> List[Tuple[str, str]]:
+    """EXPLAIN every registered statement, returning (name, reason) for each failure"""
+    await conn.execute(f"SET plan_cache_mode = {plan_cache_mode}")
+    generic = plan_cache_mode == 'force_generic_plan'
+    row = await conn.fetchrow("SELECT id, created_at FROM code_blocks ORDER BY created_at DESC, id DESC OFFSET 1000 LIMIT 1")
+    block_ids = [r['id'] for r in await conn.fetch("SELECT id FROM code_blocks LIMIT 50")]
+    failures = []
+    for name, sql in cbm.STATEMENTS.items():
+        params = sample_params(name, row['id'], row['created_at'], block_ids)
+        # EXPLAIN without ANALYZE plans the statement but never runs it, so the upsert writes nothing
+        plan = await explain(conn, sql, params, generic)
+        scans = [(node['Node Type'], node.get('Index Name') or node.get('Relation Name', ''))
+                 for node in plan_nodes(plan) if 'Scan' in node['Node Type']]
+        seq_scans = [node for node in plan_nodes(plan)
+                     if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') == 'code_blocks']
+        status = 'ok'
+        if seq_scans and not name.startswith(EXEMPT_PREFIXES):
+            status = 'SEQ SCAN'
+            failures.append((name, 'sequential scan on code_blocks'))
+        print(f"[{plan_cache_mode}] {status:8} {name}: {', '.join(f'{t} {r}' for t, r in scans) or plan['Node Type']}")
+    return failures
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000, help="seed code_blocks up to this many rows")
+    parser.add_argument('--plan-cache-mode', choices=('custom', 'generic', 'both'), default='both')
+    args = parser.parse_args()
+
+    await cbm.run_migrations()
+    conn = await asyncpg.connect(cbm.DATABASE_URL, server_settings={
+        'pg_trgm.word_similarity_threshold': str(cbm.FUZZY_THRESHOLD)})
+    try:
+        await seed_blocks(conn, args.rows)
+        modes = ('custom', 'generic') if args.plan_cache_mode == 'both' else (args.plan_cache_mode,)
+        failures = []
+        for mode in modes:
+            failures += await check_plans(conn, f"force_{mode}_plan")
+    finally:
+        await conn.close()
+    if failures:
+        print(f"{len(failures)} plan(s) scan code_blocks sequentially:", file=sys.stderr)
+        for name, reason in failures:
+            print(f"  {name}: {reason}", file=sys.stderr)
+        sys.exit(1)
+    print(f"All {len(cbm.STATEMENTS)} statements use index scans")
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""Shared setup for the benchmark and check scripts in this directory.
+
+Scripts that need a database use DATABASE_URL and write synthetic rows into
+its code_blocks table, so point it at a scratch database.
+"""
+import os
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Sequence
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# CPU-only benchmarks never connect, but the module refuses to import without a URL
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/code_blocks_benchmark')
+
+import asyncpg  # noqa: E402
+
+import code_block_manager as cbm  # noqa: E402
+
+WORDS = (
+    'parse', 'json', 'request', 'user', 'cache', 'retry', 'token', 'config', 'stream', 'batch',
+    'file', 'path', 'date', 'iso', 'format', 'query', 'index', 'search', 'debounce', 'throttle',
+    'hash', 'merge', 'sort', 'filter', 'map', 'reduce', 'validate', 'schema', 'email', 'url',
+    'socket', 'timeout', 'buffer', 'queue', 'worker', 'pool', 'lock', 'event', 'handler', 'route',
+)
+
+# (language, weight, template); {a}-{d} are words and {n} makes each block unique
+TEMPLATES = (
+    ('python', 5, "def {a}_{b}_{n}({c}):\n    \"\"\"{a} {b} for {c}\"\"\"\n    return {d}.{a}({c})\n"),
+    ('javascript', 3, "function {a}{n}({c}) {{\n  const {b} = {d}.{a}({c});\n  return {b};\n}}\n"),
+    ('typescript', 2, "export function {a}{n}({c}: string): {b} {{\n  return {d}.{a}({c}) as {b};\n}}\n"),
+    ('sql', 1, "SELECT {a}, {b} FROM {c}_{n} WHERE {d} = $1 ORDER BY {a};\n"),
+    ('go', 1, "func {a}{n}({c} string) error {{\n\t{b} := {d}.{a}({c})\n\treturn {b}\n}}\n"),
+)
+_LANGUAGES = [language for language, _, _ in TEMPLATES]
+_WEIGHTS = [weight for _, weight, _ in TEMPLATES]
+_TEMPLATES = {language: template for language, _, template in TEMPLATES}
+
+def synthetic_block(n: int, rng: random.Random) -> Dict[str, Any]:
+    """A unique, plausible code block built from WORDS"""
+    language = rng.choices(_LANGUAGES, _WEIGHTS)[0]
+    a, b, c, d = rng.sample(WORDS, 4)
+    code = _TEMPLATES[language].format(a=a, b=b, c=c, d=d, n=n)
+    return {
+        'code': code,
+        'description': f"{a} {b} {c} helper",
+        'language': language,
+        'tags': [a, b],
+        'usage_count': int(rng.expovariate(0.2)),
+        'success_rate': round(rng.uniform(0.5, 1.0), 3),
+    }
+
+def sample_rows(count: int, code_chars: int = 2000, seed: int = 1) -> List[Dict[str, Any]]:
+    """Rows shaped like a _block_columns SELECT (full and summary), for CPU-only benchmarks"""
+    rng = random.Random(seed)
+    created_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for n in range(count):
+        block = synthetic_block(n, rng)
+        code = (block['code'] * (code_chars // len(block['code']) + 1))[:code_chars]
+        rows.append({
+            'id': uuid.UUID(int=rng.getrandbits(128)),
+            'hash': cbm.hash_code(code, block['language']),
+            'code': code,
+            'preview': code[:cbm.SUMMARY_PREVIEW_CHARS],
+            'description': block['description'],
+            'language': block['language'],
+            'tags': block['tags'],
+            'usage_count': block['usage_count'],
+            'success_rate': block['success_rate'],
+            'created_at': created_at + timedelta(seconds=n),
+        })
+    return rows
+
+async def seed_blocks(conn: asyncpg.Connection, rows: int, batch_size: int = 50000) -> int:
+    """Top code_blocks up to `rows` synthetic blocks with COPY and ANALYZE it; returns rows added"""
+    existing = await conn.fetchval("SELECT count(*) FROM code_blocks")
+    rng = random.Random(existing)
+    start = datetime.now(timezone.utc) - timedelta(days=365)
+    columns = ('hash', 'code', 'description', 'language', 'tags', 'usage_count', 'success_rate', 'created_at')
+    added = 0
+    for first in range(existing, rows, batch_size):
+        records = []
+        for n in range(first, min(first + batch_size, rows)):
+            block = synthetic_block(n, rng)
+            records.append((
+                cbm.hash_code(block['code'], block['language']), block['code'], block['description'],
+                block['language'], block['tags'], block['usage_count'], block['success_rate'],
+                start + timedelta(seconds=n * 365 * 86400 / max(rows, 1)),
+            ))
+        await conn.copy_records_to_table('code_blocks', records=records, columns=columns)
+        added += len(records)
+        print(f"seeded {existing + added}/{rows} blocks", file=sys.stderr)
+    await conn.execute("ANALYZE code_blocks")
+    return added
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    """Nearest-rank percentile of values (pct in 0-100)"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
@@ -0,0 +1,112 @@
+"""Labelled snippets for checking language detection accuracy.
+
+Each entry is (language, code). Several are chosen to trip keyword-order
+detectors: Python-like words in JavaScript, 'class' outside Python, SQL in
+lower case and Go without `package main`. REALISTIC_SAMPLES are the short
+pastes people actually store: an import and a line of usage, one query, one
+rule, one tag, with few of the keywords a whole file would carry.
+"""
+
+SAMPLES = [
+    ('python', "def add(a, b):\n    return a + b\n"),
+    ('python', "from typing import List\n\nclass Foo:\n    def __init__(self):\n        self.x = 1\n"),
+    ('python', "import os\nprint(os.getcwd())\n"),
+    ('python', "for item in items:\n    if item is None:\n        continue\n    elif item > 3:\n        print(item)\n"),
+    ('javascript', "const add = (a, b) => a + b;\nconsole.log(add(1, 2));\n"),
+    ('javascript', "function debounce(fn, ms) {\n  let t;\n  return function(...args) {\n    clearTimeout(t);\n    t = setTimeout(() => fn.apply(this, args), ms);\n  };\n}\n"),
+    ('javascript', "import React from 'react';\nexport default function App() { return null; }\n"),
+    ('javascript', "class Stack {\n  constructor() { this.items = []; }\n  push(x) { this.items.push(x); }\n}\n"),
+    ('javascript', "const fs = require('fs');\nif (a === b) { document.title = 'x'; }\n"),
+    ('typescript', "interface User {\n  name: string;\n  age: number;\n}\n"),
+    ('typescript', "export function greet(name: string): void {\n  console.log(`hi ${name}`);\n}\n"),
+    ('typescript', "type Point = { x: number; y: number };\nconst p: Point = { x: 1, y: 2 };\n"),
+    ('sql', "SELECT id, name FROM users WHERE age > 21 ORDER BY name;"),
+    ('sql', "CREATE TABLE users (id serial primary key, name text);"),
+    ('sql', "update users set name = 'x' where id = 1;"),
+    ('sql', "INSERT INTO logs (msg) VALUES ('hello');"),
+    ('css', ".btn {\n  color: red;\n  padding: 4px;\n}\n"),
+    ('css', "@media (max-width: 600px) {\n  .nav { display: none; }\n}\n"),
+    ('html', "<!DOCTYPE html>\n<html><body><div>Hello</div></body></html>"),
+    ('html', "<div class=\"card\">\n  <span>Title</span>\n</div>"),
+    ('java', "public class Main {\n  public static void main(String[] args) {\n    System.out.println(\"hi\");\n  }\n}\n"),
+    ('java', "import java.util.List;\n\npublic class Repo {\n  private final List<String> items = new ArrayList<>();\n  @Override\n  public String toString() { return \"\"; }\n}\n"),
+    ('go', "package main\n\nimport \"fmt\"\n\nfunc main() {\n\tx := 1\n\tfmt.Println(x)\n}\n"),
+    ('go', "func (s *Server) Start() error {\n\tdefer s.Close()\n\treturn nil\n}\n"),
+    ('rust', "fn main() {\n    let mut v = vec![1, 2];\n    v.push(3);\n    println!(\"{:?}\", v);\n}\n"),
+    ('rust', "use std::collections::HashMap;\n\nimpl Cache {\n    fn get(&mut self, k: &str) -> Option<&String> { self.map.get(k) }\n}\n"),
+    ('python', "class Config:\n    DEBUG = False\n"),
+    ('go', "package util\n\nfunc Add(a int, b int) int {\n\treturn a + b\n}\n"),
+]
+
+REALISTIC_SAMPLES = [
+    ('python', "import numpy as np\nx = np.array([1,2])"),
+    ('python', "import pandas as pd\ndf = pd.read_csv('data.csv')\ndf.head()"),
+    ('python', "import matplotlib.pyplot as plt\nplt.plot(xs, ys)\nplt.show()"),
+    ('python', "with open('data.txt') as f:\n    lines = f.readlines()"),
+    ('python', "squares = [x * x for x in range(10) if x % 2 == 0]"),
+    ('python', "try:\n    value = int(text)\nexcept ValueError:\n    value = 0"),
+    ('python', "import requests\nr = requests.get(url, timeout=5)\nr.raise_for_status()\ndata = r.json()"),
+    ('python', "if __name__ == '__main__':\n    main()"),
+    ('python', "@app.route('/health')\ndef health():\n    return {'ok': True}"),
+    ('python', "from django.db import models\n\nclass Post(models.Model):\n    title = models.CharField(max_length=200)"),
+    ('python', "async def fetch(session, url):\n    async with session.get(url) as resp:\n        return await resp.json()"),
+    ('python', "counts = {}\nfor word in text.split():\n    counts[word] = counts.get(word, 0) + 1"),
+    ('python', "from collections import defaultdict\ngroups = defaultdict(list)"),
+    ('python', "sorted(users, key=lambda u: u.age, reverse=True)"),
+    ('python', "while not done:\n    done = step()"),
+    ('javascript', "document.getElementById('save').addEventListener('click', save);"),
+    ('javascript', "fetch('/api/items')\n  .then(res => res.json())\n  .then(items => render(items));"),
+    ('javascript', "const express = require('express');\nconst app = express();\napp.listen(3000);"),
+    ('javascript', "const total = items.reduce((sum, item) => sum + item.price, 0);"),
+    ('javascript', "module.exports = { add, subtract };"),
+    ('javascript', "async function load() {\n  const res = await fetch(url);\n  return res.json();\n}"),
+    ('javascript', "useEffect(() => {\n  setCount(0);\n}, []);"),
+    ('javascript', "import { useState } from 'react';"),
+    ('javascript', "import axios from \"axios\";\nconst { data } = await axios.get(url);"),
+    ('javascript', "export const selectUser = (state) => state.user;"),
+    ('javascript', "localStorage.setItem('token', JSON.stringify(token));"),
+    ('javascript', "for (let i = 0; i < items.length; i++) {\n  console.log(items[i]);\n}"),
+    ('typescript', "export type Props = {\n  title: string;\n  onClick: () => void;\n};"),
+    ('typescript', "constructor(private readonly http: HttpClient) {}"),
+    ('typescript', "function identity<T>(arg: T): T {\n  return arg;\n}"),
+    ('typescript', "const ids: number[] = users.map(u => u.id);"),
+    ('typescript', "export interface ApiResponse<T> {\n  data: T;\n  error?: string;\n}"),
+    ('typescript', "enum Direction {\n  Up,\n  Down,\n}\nlet d: Direction = Direction.Up;"),
+    ('sql', "SELECT * FROM orders;"),
+    ('sql', "select country, count(*) from users group by country;"),
+    ('sql', "ALTER TABLE users ADD COLUMN email text;"),
+    ('sql', "DROP TABLE IF EXISTS tmp_import;"),
+    ('sql', "SELECT u.name, o.total\nFROM users u\nJOIN orders o ON o.user_id = u.id;"),
+    ('sql', "WITH recent AS (\n  SELECT * FROM events WHERE ts > now() - interval '1 day'\n)\nSELECT count(*) FROM recent;"),
+    ('sql', "DELETE FROM sessions WHERE expires_at < now();"),
+    ('css', "body { margin: 0; font-family: sans-serif; }"),
+    ('css', ".container {\n  display: flex;\n  justify-content: center;\n  align-items: center;\n}"),
+    ('css', "a:hover { text-decoration: underline; }"),
+    ('css', "h1 { font-size: 2rem; color: #333; }"),
+    ('css', ":root {\n  --primary: #0066cc;\n}"),
+    ('html', "<button onclick=\"save()\">Save</button>"),
+    ('html', "<a href=\"/about\">About</a>"),
+    ('html', "<img src=\"logo.png\" alt=\"Logo\">"),
+    ('html', "<h2>Installation</h2>\n<p>Run the installer.</p>"),
+    ('html', "<ul>\n  <li>One</li>\n  <li>Two</li>\n</ul>"),
+    ('html', "<table>\n  <tr><td>1</td><td>2</td></tr>\n</table>"),
+    ('html', "<script src=\"app.js\"></script>"),
+    ('html', "<meta name=\"viewport\" content=\"width=device-width, initial-scale=1\">"),
+    ('java', "List<String> names = new ArrayList<>();"),
+    ('java', "System.out.println(\"Hello, World!\");"),
+    ('java', "@Autowired\nprivate UserRepository userRepository;"),
+    ('java', "public interface Shape {\n    double area();\n}"),
+    ('java', "try {\n    Files.readAllLines(path);\n} catch (IOException e) {\n    e.printStackTrace();\n}"),
+    ('java', "Map<String, Integer> counts = new HashMap<>();"),
+    ('go', "if err != nil {\n\treturn err\n}"),
+    ('go', "for i := 0; i < 10; i++ {\n\tfmt.Println(i)\n}"),
+    ('go', "type User struct {\n\tName string `json:\"name\"`\n}"),
+    ('go', "ch := make(chan int)\ngo worker(ch)"),
+    ('go', "resp, err := http.Get(url)"),
+    ('rust', "let x: i32 = 5;"),
+    ('rust', "#[derive(Debug, Clone)]\nstruct Point {\n    x: f64,\n    y: f64,\n}"),
+    ('rust', "match opt {\n    Some(v) => v,\n    None => 0,\n}"),
+    ('rust', "let s = String::from(\"hello\");"),
+    ('rust', "fn add(a: i32, b: i32) -> i32 { a + b }"),
+    ('rust', "let file = File::open(\"config.toml\")?;"),
+]
@@ -0,0 +1,85 @@
+"""p99 search latency while large blocks are being ingested.
+
+Migrates and seeds the database, then runs --searchers concurrent full-text
+searches in-process for --seconds: once with no writes, then once per
+ANALYSIS_EXECUTOR setting in --executors while --ingesters tasks store
+blocks of --block-chars through store_code_block (language and tags left
+for analysis to fill in). With 'none' the analysis runs on the event loop
+and stalls the searches; 'process' and 'thread' offload it.
+
+    DATABASE_URL=postgresql://localhost/scratch python benchmarks/loadtest_ingest.py
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import List
+
+import asyncpg
+
+from common import cbm, percentile, seed_blocks, synthetic_block
+
+QUERIES = ('parse json', 'cache retry', 'stream batch', 'validate schema', 'socket timeout')
+
+async def search_loop(deadline: float, latencies: List[float]):
+    n = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        await cbm.search_code_blocks(QUERIES[n % len(QUERIES)], limit=20, mode='fulltext')
+        latencies.append(time.perf_counter() - started)
+        n += 1
+
+async def ingest_loop(deadline: float, block_chars: int, rng: random.Random) -> int:
+    stored = 0
+    while time.perf_counter() < deadline:
+        block = synthetic_block(rng.getrandbits(48), rng)
+        code = (block['code'] * (block_chars // len(block['code']) + 1))[:block_chars]
+        await cbm.store_code_block(cbm.CodeBlockCreate(
+            code=code, description=block['description'], language='auto', tags=[]))
+        stored += 1
+    return stored
+
+async def run_phase(name: str, args: argparse.Namespace, ingest: bool):
+    deadline = time.perf_counter() + args.seconds
+    latencies: List[float] = []
+    rng = random.Random(name)
+    ingesters = [ingest_loop(deadline, args.block_chars, rng) for _ in range(args.ingesters if ingest else 0)]
+    results = await asyncio.gather(*ingesters, *(search_loop(deadline, latencies) for _ in range(args.searchers)))
+    stored = sum(results[:len(ingesters)])
+    print(f"{name:16} {len(latencies):6} searches  p50 {percentile(latencies, 50) * 1e3:7.1f}ms  "
+          f"p99 {percentile(latencies, 99) * 1e3:7.1f}ms  max {max(latencies, default=0) * 1e3:7.1f}ms  "
+          f"{stored} blocks stored")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000, help="seed code_blocks up to this many rows")
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--searchers', type=int, default=8)
+    parser.add_argument('--ingesters', type=int, default=2)
+    parser.add_argument('--block-chars', type=int, default=200_000)
+    parser.add_argument('--executors', default='none,process', help="comma-separated ANALYSIS_EXECUTOR values")
+    args = parser.parse_args()
+
+    await cbm.run_migrations()
+    conn = await asyncpg.connect(cbm.DATABASE_URL)
+    try:
+        await seed_blocks(conn, args.rows)
+    finally:
+        await conn.close()
+    await cbm.init_db()
+    try:
+        print(f"{args.searchers} searchers, {args.ingesters} ingesters of {args.block_chars} chars, "
+              f"ANALYSIS_OFFLOAD_CHARS={cbm.ANALYSIS_OFFLOAD_CHARS}, ANALYSIS_WORKERS={cbm.ANALYSIS_WORKERS}")
+        await run_phase('no ingest', args, ingest=False)
+        for executor in args.executors.split(','):
+            cbm.ANALYSIS_EXECUTOR = executor
+            cbm.init_analysis_executor()
+            try:
+                await run_phase(f"ingest, {executor}", args, ingest=True)
+            finally:
+                cbm.close_analysis_executor()
+    finally:
+        await cbm.close_db()
+
+if __name__ == '__main__':
+    asyncio.run(main())
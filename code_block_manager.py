@@ -7,23 +7,56 @@ Code Block Manager - Full Application
 """
 
 import asyncio
+import base64
+import bisect
+import contextlib
+import contextvars
+import itertools
 import hashlib
+import heapq
 import json
+import math
 import os
 import re
-from datetime import datetime
-from typing import List, Dict, Optional, Any
+import sys
+import textwrap
+import time
+import uuid
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from typing import List, Dict, Optional, Any, Tuple, AsyncIterator, Union, Callable, Awaitable
 from dataclasses import dataclass, field
 
 import asyncpg
-from fastapi import FastAPI, HTTPException, Form, Request
+from fastapi import FastAPI, HTTPException, Form, Request, Response
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+from pydantic import BaseModel, ValidationError
 from dotenv import load_dotenv
 import uvicorn
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Load environment variables
 load_dotenv()
 
@@ -37,6 +70,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Database connection
@@ -47,6 +81,311 @@ if not DATABASE_URL:
 # Global database pool
 db_pool: Optional[asyncpg.Pool] = None
 
+# Pool sizing: DB_POOL_MIN_SIZE connections are opened at startup and kept,
+# extra ones up to DB_POOL_MAX_SIZE are closed after DB_POOL_MAX_IDLE_SECONDS
+# idle. Requests waiting longer than DB_POOL_ACQUIRE_TIMEOUT for a connection
+# get a 503 instead of queueing indefinitely.
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '5'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_MAX_IDLE_SECONDS = float(os.getenv('DB_POOL_MAX_IDLE_SECONDS', '300'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '60'))
+# Read replicas (comma-separated URLs) serving searches, browsing and stats.
+# A replica is skipped while it fails the health check run every
+# REPLICA_HEALTH_SECONDS or lags more than REPLICA_MAX_LAG_SECONDS; clients
+# that stored a block in the last READ_YOUR_WRITES_SECONDS (tracked by a
+# cookie) read from the primary. A replica whose pool has no free connection
+# within REPLICA_ACQUIRE_TIMEOUT is busy, not down: that read goes to the
+# primary and the replica stays in rotation.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_HEALTH_SECONDS = float(os.getenv('REPLICA_HEALTH_SECONDS', '5'))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '10'))
+REPLICA_ACQUIRE_TIMEOUT = float(os.getenv('REPLICA_ACQUIRE_TIMEOUT', '0.5'))
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', '10'))
+WRITE_COOKIE = 'cbm_last_write'
+# Upper bounds (seconds) of the acquire wait-time histogram buckets
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Search configuration
+SEARCH_MODES = ('fulltext', 'substring', 'fuzzy', 'ilike', 'semantic', 'hybrid')
+SEARCH_MODE = os.getenv('SEARCH_MODE', 'fulltext')
+# 'simple' keeps identifiers intact (no stemming or stop words). Migration 2
+# bakes it into the search_vector trigger, so startup refuses to run with a
+# different value than the one the existing vectors were built with.
+FTS_CONFIG = os.getenv('SEARCH_FTS_CONFIG', 'simple')
+# Minimum pg_trgm word similarity for mode=fuzzy
+FUZZY_THRESHOLD = float(os.getenv('SEARCH_FUZZY_THRESHOLD', '0.4'))
+
+# 'database' runs searches in Postgres; 'memory' serves mode=fulltext from an
+# in-process BM25 index (scored with numpy) built at startup and refreshed
+# periodically
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'database')
+MEMORY_SEARCH = SEARCH_BACKEND == 'memory' and numpy is not None
+SEARCH_INDEX_REFRESH_SECONDS = float(os.getenv('SEARCH_INDEX_REFRESH_SECONDS', '30'))
+
+# Near-duplicate detection: 'flag' reports similar blocks when storing,
+# 'merge' counts a near-duplicate as a reuse of the most similar block, 'off'
+# disables signatures and the LSH index
+NEAR_DUP_POLICY = os.getenv('NEAR_DUP_POLICY', 'flag')
+NEAR_DUP_THRESHOLD = float(os.getenv('NEAR_DUP_THRESHOLD', '0.8'))
+NEAR_DUP_MAX_RESULTS = 5
+MINHASH_SIZE = 64
+LSH_BANDS = 16
+SHINGLE_SIZE = 4
+MINHASH_MAX_CHARS = 65536
+
+# Semantic search (mode=semantic, needs numpy) is opt-in: EMBEDDING_MODEL is
+# 'off' (default), 'hashing' (a deterministic feature-hashing vectorizer of
+# EMBEDDING_DIM dimensions) or a sentence-transformers model name run on the
+# CPU. Vectors are searched in-process by an IVF index that clusters once
+# SEMANTIC_IVF_MIN_SIZE blocks exist and scans SEMANTIC_NPROBE clusters per
+# query. Each worker holds 4 * EMBEDDING_DIM bytes per block (about 2GB for
+# 2M blocks at 256 dimensions, up to twice that while the array grows), and
+# the first start with it enabled embeds every existing row.
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'off')
+EMBEDDING_DIM = int(os.getenv('EMBEDDING_DIM', '256'))
+EMBEDDING_MAX_CHARS = 4096
+SEMANTIC_NPROBE = int(os.getenv('SEMANTIC_NPROBE', '8'))
+SEMANTIC_IVF_MIN_SIZE = int(os.getenv('SEMANTIC_IVF_MIN_SIZE', '4096'))
+SEMANTIC_SEARCH = EMBEDDING_MODEL != 'off' and numpy is not None
+
+# Hybrid ranking (mode=hybrid): the top HYBRID_CANDIDATES full-text and semantic
+# matches are fused with usage and success signals, either by weighted
+# reciprocal rank fusion ('rrf') or a weighted sum of normalized scores
+# ('linear'). HYBRID_WEIGHTS overrides weights, e.g. "text=1,usage=0.5".
+HYBRID_RANKING = os.getenv('HYBRID_RANKING', 'rrf')
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '100'))
+HYBRID_RRF_K = 60
+HYBRID_WEIGHTS = {'text': 1.0, 'semantic': 1.0, 'usage': 0.3, 'success': 0.1}
+HYBRID_WEIGHTS.update(
+    (name.strip(), float(value)) for name, _, value in
+    (item.partition('=') for item in os.getenv('HYBRID_WEIGHTS', '').split(',') if item)
+)
+
+# Search result cache: in-process LRU by default, shared when SEARCH_CACHE_URL
+# points at a Redis-compatible server; SEARCH_CACHE_SIZE=0 disables caching
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '1024'))
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv('SEARCH_CACHE_TTL_SECONDS', '60'))
+SEARCH_CACHE_URL = os.getenv('SEARCH_CACHE_URL')
+
+# Write-behind usage counting: a repeat of a recently stored block (found in a
+# hash -> id cache of USAGE_HASH_CACHE_SIZE entries) is buffered in memory and
+# added to usage_count by one batched UPDATE every USAGE_FLUSH_SECONDS, or as
+# soon as USAGE_FLUSH_MAX_PENDING increments are waiting
+USAGE_FLUSH_SECONDS = float(os.getenv('USAGE_FLUSH_SECONDS', '0.5'))
+USAGE_FLUSH_MAX_PENDING = int(os.getenv('USAGE_FLUSH_MAX_PENDING', '1000'))
+USAGE_HASH_CACHE_SIZE = int(os.getenv('USAGE_HASH_CACHE_SIZE', '100000'))
+
+# Upper bound on blocks accepted by one POST /api/blocks/bulk request
+BULK_MAX_BLOCKS = int(os.getenv('BULK_MAX_BLOCKS', '50000'))
+
+# Dedup hashing: HASH_ALGORITHM is md5, blake2b or xxh3 (needs the xxhash
+# package); DEDUP_NORMALIZE lists the normalize_code steps applied first
+# (line_endings, trailing_whitespace, indentation, comments). Both default to
+# the original raw md5 so existing rows keep matching; changing either needs
+# a `rehash` run (`python code_block_manager.py rehash`) before new inserts
+# will dedup against old rows.
+HASH_ALGORITHM = os.getenv('HASH_ALGORITHM', 'md5')
+DEDUP_NORMALIZE = set(filter(None, os.getenv(
+    'DEDUP_NORMALIZE', '').split(',')))
+
+# CPU-bound ingestion analysis (hashing, language detection, tagging) runs in a
+# 'process' or 'thread' pool for inputs of at least ANALYSIS_OFFLOAD_CHARS;
+# 'none' keeps it on the event loop
+ANALYSIS_EXECUTOR = os.getenv('ANALYSIS_EXECUTOR', 'process')
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '2'))
+ANALYSIS_OFFLOAD_CHARS = int(os.getenv('ANALYSIS_OFFLOAD_CHARS', '32768'))
+analysis_executor: Optional[Executor] = None
+
+# Streaming ingestion: blocks and NDJSON bytes that trigger a database flush
+# (whichever comes first), longest accepted NDJSON line, and how many recent
+# jobs keep their progress for GET /api/ingest/{job_id}
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', '1000'))
+STREAM_BATCH_BYTES = int(os.getenv('STREAM_BATCH_BYTES', str(8 * 1024 * 1024)))
+STREAM_MAX_LINE_BYTES = int(os.getenv('STREAM_MAX_LINE_BYTES', str(16 * 1024 * 1024)))
+STREAM_MAX_ERROR_SAMPLES = 20
+INGEST_JOBS_KEPT = 100
+ingest_jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+# List views: 'full' returns the code body, 'summary' a truncated preview
+VIEWS = ('full', 'summary')
+SUMMARY_PREVIEW_CHARS = int(os.getenv('SUMMARY_PREVIEW_CHARS', '240'))
+
+# Deadline for /readyz to acquire a connection and run SELECT 1
+READY_TIMEOUT_SECONDS = float(os.getenv('READY_TIMEOUT_SECONDS', '2'))
+
+# How often the per-language statistics behind /api/stats are recomputed
+STATS_REFRESH_SECONDS = float(os.getenv('STATS_REFRESH_SECONDS', '60'))
+STATS_REFRESH_LOCK_ID = 7315002
+
+# Serializes migrations when several workers start at once
+SCHEMA_LOCK_ID = 7315001
+# Startup applies heavy migrations (full-table backfills and index builds)
+# only while code_blocks has fewer rows than this; bigger tables need
+# `python code_block_manager.py migrate` before the deploy, since a long
+# build would outlast the deploy healthcheck
+MIGRATE_ON_STARTUP_MAX_ROWS = int(os.getenv('MIGRATE_ON_STARTUP_MAX_ROWS', '100000'))
+# Rows per transaction of a migration backfill
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '5000'))
+
+@dataclass
+class Migration:
+    """One schema version: its statements run in a single transaction, or one by
+    one outside any transaction when concurrent (CREATE INDEX CONCURRENTLY).
+    Backfills are UPDATEs of the code_blocks rows whose id = ANY($1), run over
+    the whole table in batches that commit on their own; heavy marks
+    migrations that scan or rewrite all of code_blocks."""
+    version: int
+    name: str
+    statements: List[str]
+    concurrent: bool = False
+    backfills: List[str] = field(default_factory=list)
+    heavy: bool = False
+
+# Applied in order and recorded in schema_migrations; statements stay idempotent
+# so databases created before migrations existed upgrade cleanly
+MIGRATIONS = [
+    Migration(1, "create_code_blocks", [
+        """
+        CREATE TABLE IF NOT EXISTS code_blocks (
+            id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+            hash text NOT NULL,
+            code text NOT NULL,
+            description text NOT NULL DEFAULT '',
+            language text,
+            tags text[] NOT NULL DEFAULT '{}',
+            usage_count integer NOT NULL DEFAULT 0,
+            success_rate double precision NOT NULL DEFAULT 1.0,
+            created_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+    ]),
+    Migration(2, "search_vector", [
+        "ALTER TABLE code_blocks ADD COLUMN IF NOT EXISTS search_vector tsvector",
+        f"""
+        CREATE OR REPLACE FUNCTION code_blocks_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('{FTS_CONFIG}', coalesce(NEW.description, '')), 'A') ||
+                setweight(to_tsvector('{FTS_CONFIG}', coalesce(array_to_string(NEW.tags, ' '), '')), 'B') ||
+                setweight(to_tsvector('{FTS_CONFIG}', left(coalesce(NEW.code, ''), 500000)), 'C');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS code_blocks_search_vector_trigger ON code_blocks",
+        """
+        CREATE TRIGGER code_blocks_search_vector_trigger
+        BEFORE INSERT OR UPDATE OF description, tags, code ON code_blocks
+        FOR EACH ROW EXECUTE FUNCTION code_blocks_search_vector_update()
+        """,
+    ], backfills=[
+        # Rows written before the trigger existed
+        "UPDATE code_blocks SET description = description WHERE id = ANY($1) AND search_vector IS NULL",
+    ], heavy=True),
+    # Unique hash backs the single-statement upsert; fold any existing duplicates first
+    Migration(3, "unique_hash", [
+        """
+        DO $$
+        BEGIN
+            IF to_regclass('code_blocks_hash_key') IS NULL THEN
+                WITH ranked AS (
+                    SELECT id, usage_count,
+                           first_value(id) OVER (PARTITION BY hash ORDER BY created_at, id) AS keep_id
+                    FROM code_blocks
+                ), extra AS (
+                    SELECT keep_id, sum(usage_count + 1) AS hits
+                    FROM ranked WHERE id <> keep_id GROUP BY keep_id
+                )
+                UPDATE code_blocks SET usage_count = code_blocks.usage_count + extra.hits
+                FROM extra WHERE code_blocks.id = extra.keep_id;
+                
+                DELETE FROM code_blocks USING (
+                    SELECT id, row_number() OVER (PARTITION BY hash ORDER BY created_at, id) AS rn
+                    FROM code_blocks
+                ) ranked
+                WHERE code_blocks.id = ranked.id AND ranked.rn > 1;
+                
+                CREATE UNIQUE INDEX code_blocks_hash_key ON code_blocks (hash);
+            END IF;
+        END
+        $$
+        """,
+    ], heavy=True),
+    Migration(4, "similarity_columns", [
+        # MinHash signature (MINHASH_SIZE x uint32) for near-duplicate detection
+        "ALTER TABLE code_blocks ADD COLUMN IF NOT EXISTS minhash bytea",
+        # L2-normalized float32 embedding for mode=semantic
+        "ALTER TABLE code_blocks ADD COLUMN IF NOT EXISTS embedding bytea",
+    ]),
+    # Pre-aggregated statistics so /api/stats never scans code_blocks
+    Migration(5, "language_stats", [
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS code_block_language_stats AS
+        SELECT coalesce(language, 'unknown') AS language,
+               count(*) AS block_count,
+               sum(usage_count) AS usage_sum,
+               sum(success_rate) AS success_sum,
+               now() AS refreshed_at
+        FROM code_blocks
+        GROUP BY 1
+        """,
+        # Required by REFRESH MATERIALIZED VIEW CONCURRENTLY
+        "CREATE UNIQUE INDEX IF NOT EXISTS code_block_language_stats_language_idx ON code_block_language_stats (language)",
+    ]),
+    Migration(6, "pg_trgm", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    ]),
+    # Built without blocking writes to code_blocks
+    Migration(7, "search_indexes", [
+        # Keyset pagination for browsing newest first
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS code_blocks_created_at_id_idx ON code_blocks (created_at DESC, id DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS code_blocks_search_vector_idx ON code_blocks USING gin (search_vector)",
+        # Trigram indexes back mode=substring (ILIKE) and mode=fuzzy (<%)
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS code_blocks_code_trgm_idx ON code_blocks USING gin (code gin_trgm_ops)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS code_blocks_description_trgm_idx ON code_blocks USING gin (description gin_trgm_ops)",
+        # Language filter of every search mode
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS code_blocks_language_idx ON code_blocks (language)",
+    ], concurrent=True, heavy=True),
+    # Commit-ordered change feed for the in-process indexes (see sync_index).
+    # created_at is the transaction start, so a slow transaction's rows can
+    # commit behind a created_at watermark; the inserting transaction id can
+    # be compared with a snapshot's xmin instead. Rows that predate the
+    # column stay NULL and are only read by full builds.
+    Migration(8, "change_tracking", [
+        "ALTER TABLE code_blocks ADD COLUMN IF NOT EXISTS created_xid xid8",
+        "ALTER TABLE code_blocks ALTER COLUMN created_xid SET DEFAULT pg_current_xact_id()",
+        """
+        CREATE TABLE IF NOT EXISTS code_block_deletions (
+            id text NOT NULL,
+            deleted_xid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+            deleted_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS code_block_deletions_deleted_xid_idx ON code_block_deletions (deleted_xid)",
+        """
+        CREATE OR REPLACE FUNCTION code_blocks_record_deletions() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO code_block_deletions (id) SELECT id::text FROM deleted_rows;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS code_blocks_deletions_trigger ON code_blocks",
+        """
+        CREATE TRIGGER code_blocks_deletions_trigger
+        AFTER DELETE ON code_blocks
+        REFERENCING OLD TABLE AS deleted_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION code_blocks_record_deletions()
+        """,
+    ]),
+    Migration(9, "change_tracking_index", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS code_blocks_created_xid_idx ON code_blocks (created_xid)",
+    ], concurrent=True, heavy=True),
+]
+
+_CONCURRENT_INDEX_RE = re.compile(r'CREATE (?:UNIQUE )?INDEX CONCURRENTLY IF NOT EXISTS (\w+)')
+
 @dataclass
 class CodeBlock:
     id: Optional[str] = None
@@ -82,226 +421,2119 @@ class CodeBlockResponse(BaseModel):
     success_rate: float
     created_at: str
 
+class CodeBlockSummary(BaseModel):
+    id: str
+    hash: str
+    preview: str
+    description: str
+    language: str
+    tags: List[str]
+    usage_count: int
+    success_rate: float
+    created_at: str
+
 # Database functions
+class PoolTimeoutError(Exception):
+    """No pooled connection became free within DB_POOL_ACQUIRE_TIMEOUT"""
+
+class PoolStats:
+    """Connection acquire counters and wait-time histogram"""
+    
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.wait_total = 0.0
+        self.acquired = 0
+        self.timeouts = 0
+        self.waiting = 0
+    
+    def observe(self, wait: float):
+        self.counts[bisect.bisect_left(self.buckets, wait)] += 1
+        self.wait_total += wait
+        self.acquired += 1
+    
+    def metrics(self, pool: Optional[asyncpg.Pool]) -> Dict[str, Any]:
+        size = pool.get_size() if pool else 0
+        idle = pool.get_idle_size() if pool else 0
+        max_size = pool.get_max_size() if pool else 0
+        # Cumulative counts per upper bound, Prometheus style
+        histogram = {}
+        total = 0
+        for bound, count in zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts):
+            total += count
+            histogram[bound] = total
+        return {
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "max_size": max_size,
+            "saturation": (size - idle) / max_size if max_size else 1.0,
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "wait_seconds_sum": self.wait_total,
+            "wait_seconds_buckets": histogram,
+        }
+
+pool_stats = PoolStats(POOL_WAIT_BUCKETS)
+
+class Replica:
+    """A read replica's pool and last health check result"""
+    
+    def __init__(self, url: str):
+        self.url = url
+        self.pool: Optional[asyncpg.Pool] = None
+        self.healthy = False
+        self.lag: Optional[float] = None
+        self.error: Optional[str] = None
+        self.acquire_timeouts = 0
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "host": urlparse(self.url).hostname,
+            "healthy": self.healthy,
+            "lag_seconds": self.lag,
+            "error": self.error,
+            "acquire_timeouts": self.acquire_timeouts,
+            "size": self.pool.get_size() if self.pool else 0,
+            "idle": self.pool.get_idle_size() if self.pool else 0,
+        }
+
+replicas = [Replica(url) for url in DATABASE_REPLICA_URLS]
+_replica_turns = itertools.count()
+
+# Set per request when the client wrote recently and must read from the primary
+read_from_primary: contextvars.ContextVar[bool] = contextvars.ContextVar('read_from_primary', default=False)
+
+def pick_replica() -> Optional[Replica]:
+    """Next healthy replica in round-robin order, or None to use the primary"""
+    if read_from_primary.get():
+        return None
+    healthy = [replica for replica in replicas if replica.healthy]
+    if not healthy:
+        return None
+    return healthy[next(_replica_turns) % len(healthy)]
+
+@contextlib.asynccontextmanager
+async def acquire_connection(replica: bool = False) -> AsyncIterator[asyncpg.Connection]:
+    """Acquire a pooled connection, recording the wait and failing fast when saturated.
+    
+    With replica=True the connection comes from a healthy read replica when
+    there is one, falling back to the primary. A replica that fails to connect
+    is marked unhealthy; one that is merely saturated (no connection within
+    REPLICA_ACQUIRE_TIMEOUT) keeps its health and only this read moves.
+    """
+    started = time.monotonic()
+    pool_stats.waiting += 1
+    try:
+        conn = None
+        target = pick_replica() if replica else None
+        if target is not None:
+            try:
+                conn = await target.pool.acquire(timeout=REPLICA_ACQUIRE_TIMEOUT)
+                pool = target.pool
+            except asyncio.TimeoutError:
+                target.acquire_timeouts += 1
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                target.healthy = False
+                target.error = str(e) or type(e).__name__
+        if conn is None:
+            conn = await db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+            pool = db_pool
+    except asyncio.TimeoutError:
+        pool_stats.timeouts += 1
+        raise PoolTimeoutError(f"No database connection available within {DB_POOL_ACQUIRE_TIMEOUT}s")
+    finally:
+        pool_stats.waiting -= 1
+    pool_stats.observe(time.monotonic() - started)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+def server_error(e: Exception) -> HTTPException:
+    """HTTP error for an unexpected failure; a saturated pool is a retryable 503"""
+    if isinstance(e, PoolTimeoutError):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    return HTTPException(status_code=500, detail=str(e))
+
+# Hot query shapes (name -> SQL). Call sites run them by name through
+# conn.fetch and friends; asyncpg's per-connection statement cache prepares
+# each shape on first use and reuses it after, and fixed SQL text keeps the
+# cache hitting
+STATEMENTS: Dict[str, str] = {}
+
+def register_statement(name: str, sql: str) -> str:
+    """Add a query shape to the registry, returning its name"""
+    STATEMENTS[name] = sql
+    return name
+
 async def init_db():
-    """Initialize database connection"""
+    """Initialize the database pool, opening DB_POOL_MIN_SIZE connections up front"""
     global db_pool
-    db_pool = await asyncpg.create_pool(
-        DATABASE_URL,
-        min_size=1,
-        max_size=10,
-        command_timeout=60
+    db_pool = await create_app_pool(DATABASE_URL)
+
+async def create_app_pool(url: str) -> asyncpg.Pool:
+    """Create a pool (primary or replica) with the configured sizing"""
+    return await asyncpg.create_pool(
+        url,
+        min_size=min(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=DB_POOL_MAX_IDLE_SECONDS,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        # Room for every registered shape plus ad-hoc queries
+        statement_cache_size=len(STATEMENTS) + 100,
+        server_settings={'pg_trgm.word_similarity_threshold': str(FUZZY_THRESHOLD)}
     )
 
+async def check_replica(replica: Replica):
+    """Connect to a replica if needed and update its health and replication lag"""
+    try:
+        if replica.pool is None:
+            replica.pool = await asyncio.wait_for(create_app_pool(replica.url), READY_TIMEOUT_SECONDS * 5)
+        async with replica.pool.acquire(timeout=READY_TIMEOUT_SECONDS) as conn:
+            # An idle primary leaves the replay timestamp behind; a replica that
+            # has replayed everything it received is not lagging
+            lag = await conn.fetchval("""
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+                END::float8
+            """, timeout=READY_TIMEOUT_SECONDS)
+        replica.lag = lag
+        replica.healthy = lag <= REPLICA_MAX_LAG_SECONDS
+        replica.error = None if replica.healthy else f"Replication lag {lag:.1f}s"
+    except Exception as e:
+        replica.healthy = False
+        replica.error = str(e) or type(e).__name__
+
+async def run_replica_health_checker():
+    """Re-check every replica periodically so failed ones rejoin when they recover"""
+    while True:
+        await asyncio.sleep(REPLICA_HEALTH_SECONDS)
+        await asyncio.gather(*(check_replica(replica) for replica in replicas))
+
+async def run_backfill(conn: asyncpg.Connection, update: str):
+    """Run a migration backfill over code_blocks in id order, one batch per transaction"""
+    last_id = None
+    while True:
+        if last_id is None:
+            rows = await conn.fetch("SELECT id FROM code_blocks ORDER BY id LIMIT $1", MIGRATION_BATCH_SIZE)
+        else:
+            rows = await conn.fetch("SELECT id FROM code_blocks WHERE id > $1 ORDER BY id LIMIT $2",
+                                    last_id, MIGRATION_BATCH_SIZE)
+        if not rows:
+            return
+        await conn.execute(update, [row['id'] for row in rows])
+        last_id = rows[-1]['id']
+
+async def count_code_blocks(conn: asyncpg.Connection) -> int:
+    """Planner estimate of the code_blocks row count (exact if never analyzed)"""
+    estimate = await conn.fetchval("SELECT reltuples FROM pg_class WHERE oid = to_regclass('code_blocks')")
+    if estimate is None:
+        return 0
+    if estimate < 0:
+        return await conn.fetchval("SELECT count(*) FROM code_blocks")
+    return int(estimate)
+
+async def run_migrations(max_heavy_rows: Optional[int] = None) -> List[int]:
+    """Apply pending MIGRATIONS in order, returning the versions applied.
+    
+    Runs on a dedicated connection without a command timeout, since index
+    builds on a large table can take minutes. With max_heavy_rows set, a
+    pending heavy migration on a code_blocks table at least that big raises
+    instead of running.
+    """
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        # Poll rather than block: a session waiting on the lock would hold a
+        # snapshot that CREATE INDEX CONCURRENTLY has to wait for
+        while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", SCHEMA_LOCK_ID):
+            await asyncio.sleep(0.5)
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version integer PRIMARY KEY,
+                    name text NOT NULL,
+                    applied_at timestamptz NOT NULL DEFAULT now()
+                )
+            """)
+            applied = {row['version'] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+            versions = []
+            for migration in MIGRATIONS:
+                if migration.version in applied:
+                    continue
+                if migration.heavy and max_heavy_rows is not None:
+                    rows = await count_code_blocks(conn)
+                    if rows >= max_heavy_rows:
+                        raise RuntimeError(
+                            f"Migration {migration.version} ({migration.name}) rebuilds data or indexes "
+                            f"for {rows} code blocks; run `python code_block_manager.py migrate` before "
+                            f"starting the app (MIGRATE_ON_STARTUP_MAX_ROWS={max_heavy_rows})")
+                if migration.concurrent:
+                    for statement in migration.statements:
+                        # A failed concurrent build leaves an invalid index that IF NOT EXISTS would keep
+                        match = _CONCURRENT_INDEX_RE.search(statement)
+                        if match and await conn.fetchval(
+                                "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)",
+                                match.group(1)):
+                            await conn.execute(f"DROP INDEX CONCURRENTLY {match.group(1)}")
+                        await conn.execute(statement)
+                else:
+                    async with conn.transaction():
+                        for statement in migration.statements:
+                            await conn.execute(statement)
+                # Recorded last, so an interrupted backfill resumes on the next run
+                for update in migration.backfills:
+                    await run_backfill(conn, update)
+                await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                                   migration.version, migration.name)
+                versions.append(migration.version)
+            await check_fts_config(conn)
+            return versions
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", SCHEMA_LOCK_ID)
+    finally:
+        await conn.close()
+
+async def check_fts_config(conn: asyncpg.Connection):
+    """Fail if SEARCH_FTS_CONFIG differs from the config the search_vector trigger was created with.
+    
+    Queries parsed with one config don't match vectors built with another,
+    so a mismatch would silently break full-text search.
+    """
+    source = await conn.fetchval(
+        "SELECT prosrc FROM pg_proc WHERE proname = 'code_blocks_search_vector_update'")
+    match = re.search(r"to_tsvector\('([^']+)'", source or '')
+    if match and match.group(1) != FTS_CONFIG:
+        raise RuntimeError(
+            f"SEARCH_FTS_CONFIG is '{FTS_CONFIG}' but existing search vectors use '{match.group(1)}'; "
+            f"set SEARCH_FTS_CONFIG={match.group(1)}")
+
+def init_analysis_executor():
+    """Create the executor used for CPU-bound ingestion analysis"""
+    global analysis_executor
+    if ANALYSIS_EXECUTOR == 'process':
+        analysis_executor = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS)
+    elif ANALYSIS_EXECUTOR == 'thread':
+        analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS)
+
+def close_analysis_executor():
+    """Shut down the analysis executor"""
+    global analysis_executor
+    if analysis_executor:
+        analysis_executor.shutdown(cancel_futures=True)
+        analysis_executor = None
+
 async def close_db():
     """Close database connection"""
     global db_pool
+    for replica in replicas:
+        if replica.pool:
+            await replica.pool.close()
     if db_pool:
         await db_pool.close()
 
+# Language signatures: "token" or "token token" (adjacent tokens) -> weight.
+# Case-insensitive languages also match the UPPER and Title forms.
+LANGUAGE_SIGNATURES: Dict[str, Dict[str, float]] = {
+    'python': {
+        'def': 3, 'elif': 3, '__init__': 3, '__name__': 3, 'self': 1, 'None': 1,
+        'True': 1, 'False': 1, 'print': 1, 'lambda': 1, 'import': 2, 'as': 1, 'from': 1,
+        'pass': 2, 'async def': 1, ') :': 1, '] :': 1, 'in': 1, 'in range': 2,
+        'try :': 3, 'except': 3, 'with open': 3,
+    },
+    'javascript': {
+        'function': 2, '=>': 1, 'const': 1, 'let': 1, 'var': 1, '===': 2, '!==': 2,
+        'console .log': 3, 'console .error': 3, 'require (': 2, 'document': 2,
+        'window': 2, 'this': 1, 'export default': 2, 'module .exports': 3,
+        'undefined': 2, 'constructor (': 2, 'import {': 3, "from '": 4, 'from "': 4,
+        'JSON .stringify': 3, 'JSON .parse': 3, 'localStorage': 3, 'useState': 2,
+        'useEffect': 3,
+    },
+    'typescript': {
+        'interface': 2, ': string': 3, ': number': 3, ': boolean': 3, ': any': 3,
+        ': void': 3, 'readonly': 2, 'type': 1, 'as const': 2, 'implements': 1,
+        'enum': 1,
+    },
+    'sql': {
+        'select': 2, 'from': 1, 'where': 2, 'insert into': 4, 'delete from': 4,
+        'update': 1, 'set': 1, 'create table': 5, 'create index': 5, 'join': 2,
+        'group by': 3, 'order by': 3, 'values': 1, 'primary key': 3,
+        'alter table': 5, 'drop table': 5, 'add column': 3, 'if exists': 2,
+    },
+    'css': {
+        'color :': 2, 'margin :': 2, 'padding :': 2, 'display :': 2, 'border :': 2,
+        'background :': 2, 'font-size': 2, 'font-family': 2, 'font-weight': 2,
+        'text-align': 2, 'text-decoration': 2, 'justify-content': 2, 'align-items': 2,
+        'px': 1, 'rem': 1, ': hover': 2, ': root': 3, '@media': 4, '@keyframes': 4,
+        '@import': 1,
+    },
+    'html': {
+        '<! doctype': 5, '< div': 2, '< span': 2, '< html': 3, '< body': 3, '< head': 3,
+        '< p': 1, '< a': 1, '< ul': 2, '< li': 2, '< button': 2, '< input': 2,
+        '< form': 2, '< img': 2, '< script': 2, '< meta': 3, '< link': 2,
+        '< table': 1, '< tr': 2, '< td': 2, '< h1': 2, '< h2': 2, '< h3': 2,
+        '</': 1,
+    },
+    'java': {
+        'public': 1, 'private': 1, 'protected': 2, 'static void': 3, 'void main': 3,
+        'System .out': 5, '@Override': 4, '@Autowired': 4, 'import java': 5,
+        'extends': 1, 'implements': 2, 'new': 1, 'String': 1, 'final': 1,
+        'public interface': 3, '.printStackTrace': 4,
+    },
+    'go': {
+        'package': 3, 'func': 3, ':=': 2, 'fmt .Println': 4, 'fmt .Printf': 4,
+        'import (': 3, 'defer': 3, 'chan': 3, 'go func': 3, 'nil': 2, 'struct {': 3,
+    },
+    'rust': {
+        'fn': 3, 'let mut': 4, 'use std': 4, 'impl': 3, 'println!': 4, 'vec!': 4,
+        'format!': 3, 'panic!': 3, '&mut': 3, 'Some': 1, 'unwrap': 2, '::': 2,
+        'pub fn': 3, 'match': 1, '[ derive': 4, '? ;': 3, 'i32': 3, 'i64': 3,
+        'u8': 3, 'u32': 3, 'u64': 3, 'usize': 3, 'f64': 3,
+    },
+}
+CASE_INSENSITIVE_LANGUAGES = {'sql', 'html', 'css'}
+
+# TypeScript is a superset of JavaScript: JS evidence counts towards it once
+# any TypeScript-only signature has matched
+LANGUAGE_PARENTS = {'typescript': 'javascript'}
+
+# Only this many leading characters are scanned
+DETECT_MAX_CHARS = 8192
+# Minimum score before a language is reported instead of 'unknown'
+DETECT_MIN_SCORE = 2
+
+# Identifiers (with Rust's macro '!'), attribute access, multi-character
+# operators and tag openers; any other non-space character is its own token
+_LANGUAGE_TOKEN_RE = re.compile(r"[A-Za-z_][\w-]*!?|@\w+|\.\w+|===|!==|=>|:=|::|->|</|<!|&mut\b|\S")
+
+def _build_signature_table() -> Tuple[Dict[Any, List[Tuple[str, float]]], set]:
+    """Flatten LANGUAGE_SIGNATURES into token/bigram -> [(language, weight)] lookups"""
+    table: Dict[Any, List[Tuple[str, float]]] = {}
+    bigram_heads = set()
+    for language, signatures in LANGUAGE_SIGNATURES.items():
+        for signature, weight in signatures.items():
+            variants = {signature}
+            if language in CASE_INSENSITIVE_LANGUAGES:
+                variants |= {signature.upper(), signature.title()}
+            for variant in variants:
+                tokens = variant.split(' ')
+                key = tokens[0] if len(tokens) == 1 else tuple(tokens)
+                if len(tokens) == 2:
+                    bigram_heads.add(tokens[0])
+                table.setdefault(key, []).append((language, weight))
+    return table, bigram_heads
+
+_SIGNATURE_TABLE, _BIGRAM_HEADS = _build_signature_table()
+
+def score_language(code: str) -> Tuple[str, float]:
+    """Detect programming language from code, returning (language, confidence 0-1)"""
+    table = _SIGNATURE_TABLE
+    scores: Dict[str, float] = {}
+    previous = None
+    for token in _LANGUAGE_TOKEN_RE.findall(code, 0, DETECT_MAX_CHARS):
+        hits = table.get(token)
+        if previous is not None:
+            bigram_hits = table.get((previous, token))
+            if bigram_hits:
+                hits = hits + bigram_hits if hits else bigram_hits
+        if hits:
+            for language, weight in hits:
+                scores[language] = scores.get(language, 0) + weight
+        previous = token if token in _BIGRAM_HEADS else None
+    
+    for language, parent in LANGUAGE_PARENTS.items():
+        if language in scores and parent in scores:
+            scores[language] += scores.pop(parent)
+    
+    if not scores:
+        return 'unknown', 0.0
+    language, best = max(scores.items(), key=lambda item: item[1])
+    if best < DETECT_MIN_SCORE:
+        return 'unknown', 0.0
+    return language, best / sum(scores.values())
+
 def detect_language(code: str) -> str:
     """Detect programming language from code"""
-    code_lower = code.lower().strip()
+    return score_language(code)[0]
+
+# Common programming terms recognized as tags
+TAG_VOCABULARY = frozenset({
+    'api', 'rest', 'database', 'sql', 'react', 'component', 'function',
+    'class', 'authentication', 'auth', 'login', 'user', 'crud', 'form',
+    'validation', 'email', 'password', 'dashboard', 'admin', 'frontend',
+    'backend', 'server', 'client', 'http', 'json', 'xml', 'csv',
+    'file', 'upload', 'download', 'image', 'video', 'search', 'filter',
+    'sort', 'pagination', 'chart', 'graph', 'table', 'list', 'menu',
+    'navbar', 'sidebar', 'modal', 'popup', 'notification', 'alert',
+    'formatter', 'parser', 'validator', 'mapper', 'helper', 'utility'
+})
+
+# Language-specific patterns: tag -> compiled pattern searched in the code.
+# A tag may have several; alternations of literals scan slowly, so each
+# pattern is a single literal
+TAG_PATTERNS = (
+    ('function', re.compile(r'(?i)function')),
+    ('function', re.compile(r'def ')),
+    ('class', re.compile(r'class ')),
+    ('async', re.compile(r'async')),
+    ('async', re.compile(r'await')),
+    ('module', re.compile(r'export')),
+)
+
+MAX_TAGS = 10
+
+# Text is scanned for vocabulary terms in chunks of about this many characters
+_TAG_CHUNK_CHARS = 65536
+_NON_WORD_RE = re.compile(r'\W')
+
+def _scan_tag_vocabulary(text: str, tags: Dict[str, None]) -> bool:
+    """Add vocabulary terms from text in order of first occurrence; True once MAX_TAGS is reached"""
+    start = 0
+    while start < len(text):
+        # Extend each chunk to a word boundary so no word is split
+        boundary = _NON_WORD_RE.search(text, start + _TAG_CHUNK_CHARS)
+        end = boundary.start() if boundary else len(text)
+        words = _WORD_RE.findall(text[start:end].lower())
+        found = TAG_VOCABULARY.intersection(words).difference(tags)
+        for word in sorted(found, key=words.index):
+            tags[word] = None
+            if len(tags) >= MAX_TAGS:
+                return True
+        start = end
+    return False
+
+def extract_tags(code: str, description: str) -> List[str]:
+    """Extract relevant tags from code and description.
     
-    # TypeScript/JavaScript
-    if any(keyword in code for keyword in ['import {', 'export function', 'interface ', ': string', ': number']):
-        if 'interface ' in code or ': string' in code or ': number' in code:
-            return 'typescript'
-        return 'javascript'
+    Tags are ranked by where they are found: description terms first, then
+    language patterns, then code terms in order of first occurrence. Scanning
+    stops as soon as MAX_TAGS tags have been collected.
+    """
+    tags: Dict[str, None] = {}
+    if _scan_tag_vocabulary(description, tags):
+        return list(tags)
     
-    # Python
-    if any(keyword in code for keyword in ['def ', 'import ', 'from ', 'class ', '__init__']):
-        return 'python'
+    for tag, pattern in TAG_PATTERNS:
+        if tag not in tags and pattern.search(code):
+            tags[tag] = None
+            if len(tags) >= MAX_TAGS:
+                return list(tags)
+    
+    _scan_tag_vocabulary(code, tags)
+    return list(tags)
+
+# In-memory search index
+_WORD_RE = re.compile(r'\w+')
+_SUBWORD_RE = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+')
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase tokens, also emitting camelCase/snake_case parts"""
+    tokens = []
+    for match in _WORD_RE.finditer(text):
+        word = match.group()
+        tokens.append(word.lower())
+        parts = _SUBWORD_RE.findall(word)
+        if len(parts) > 1:
+            tokens.extend(part.lower() for part in parts)
+    return tokens
+
+def id_sort_key(block_id: Any) -> Tuple[int, int]:
+    """Unsigned 64-bit (high, low) halves that order ids like SQL and the cursor
+    form do: uuids bytewise, ints numerically"""
+    if isinstance(block_id, int):
+        return 0, block_id + (1 << 63)
+    value = block_id.int if isinstance(block_id, uuid.UUID) else uuid.UUID(block_id).int
+    return value >> 64, value & 0xFFFFFFFFFFFFFFFF
+
+def top_ranked(block_ids: List[Any], id_keys: array, candidates: "numpy.ndarray", scores: "numpy.ndarray",
+               limit: int, after: Optional[Tuple[float, Any]] = None) -> List[Tuple[Any, float]]:
+    """The `limit` best (block id, score) pairs of scored doc numbers, after a cursor.
     
-    # SQL
-    if any(keyword in code_lower for keyword in ['select ', 'insert ', 'update ', 'delete ', 'create table']):
-        return 'sql'
+    id_keys holds id_sort_key halves per doc number; ties break on them, matching
+    the SQL (rank, id) order, without touching the ids of every tied doc.
+    """
+    keys = numpy.frombuffer(id_keys, dtype=numpy.uint64).reshape(-1, 2)[candidates]
+    high, low = keys[:, 0], keys[:, 1]
+    if after is not None:
+        after_high, after_low = (numpy.uint64(half) for half in id_sort_key(after[1]))
+        keep = (scores < after[0]) | ((scores == after[0]) & (
+            (high < after_high) | ((high == after_high) & (low < after_low))))
+        candidates, scores, high, low = candidates[keep], scores[keep], high[keep], low[keep]
+    if len(scores) > limit:
+        # Keep everything tied with the limit-th score so ties break on id like the SQL path
+        cutoff = numpy.partition(scores, len(scores) - limit)[len(scores) - limit]
+        keep = scores >= cutoff
+        candidates, scores, high, low = candidates[keep], scores[keep], high[keep], low[keep]
+    order = numpy.lexsort((low, high, scores))[::-1][:limit]
+    return [(block_ids[doc], score) for doc, score in zip(candidates[order].tolist(), scores[order].tolist())]
+
+class InvertedIndex:
+    """BM25 inverted index over code blocks (token -> compact posting arrays)"""
     
-    # CSS
-    if '{' in code and '}' in code and (':' in code) and any(prop in code_lower for prop in ['color:', 'margin:', 'padding:', 'display:']):
-        return 'css'
+    # Field weights mirror the tsvector weighting (description A, tags B, code C)
+    FIELD_WEIGHTS = (('description', 3), ('tags', 2), ('code', 1))
     
-    # HTML
-    if '<' in code and '>' in code and any(tag in code_lower for tag in ['<div', '<span', '<html', '<body']):
-        return 'html'
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ready = False
+        self.block_ids: List[Any] = []
+        self.doc_numbers: Dict[str, int] = {}
+        # id_sort_key halves per doc number, for tie-breaking
+        self.id_keys = array('Q')
+        self.doc_lengths = array('I')
+        self.total_length = 0
+        # token -> (doc numbers, term frequencies); doc numbers are appended in order
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        # language -> bitmap over doc numbers
+        self.language_bitmaps: Dict[str, bytearray] = {}
+        # Doc numbers of removed blocks; their postings stay until a rebuild
+        self.removed = array('I')
+        self.synced_xmin: Optional[int] = None
     
-    # Java
-    if any(keyword in code for keyword in ['public class', 'private ', 'public static void main']):
-        return 'java'
+    def __len__(self) -> int:
+        return len(self.doc_numbers)
     
-    # Go
-    if any(keyword in code for keyword in ['package main', 'func ', 'import (']):
-        return 'go'
+    def add(self, block_id: Any, code: str, description: str, language: str, tags: List[str]):
+        """Index a block; blocks already present are ignored"""
+        if str(block_id) in self.doc_numbers:
+            return
+        doc = len(self.block_ids)
+        self.block_ids.append(block_id)
+        self.doc_numbers[str(block_id)] = doc
+        self.id_keys.extend(id_sort_key(block_id))
+        
+        fields = {'description': description or '', 'tags': ' '.join(tags or []), 'code': code or ''}
+        counts: Dict[str, int] = {}
+        for name, weight in self.FIELD_WEIGHTS:
+            for token in tokenize(fields[name]):
+                counts[token] = counts.get(token, 0) + weight
+        
+        length = sum(counts.values())
+        self.doc_lengths.append(length)
+        self.total_length += length
+        for token, count in counts.items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = (array('I'), array('H'))
+            posting[0].append(doc)
+            posting[1].append(min(count, 0xFFFF))
+        
+        bitmap = self.language_bitmaps.setdefault(language or 'unknown', bytearray())
+        if len(bitmap) <= doc >> 3:
+            bitmap.extend(bytes((doc >> 3) + 1 - len(bitmap)))
+        bitmap[doc >> 3] |= 1 << (doc & 7)
     
-    # Rust
-    if any(keyword in code for keyword in ['fn ', 'let mut', 'use std::']):
-        return 'rust'
+    def remove(self, block_id: Any):
+        """Drop a deleted block from results; unknown ids are ignored"""
+        doc = self.doc_numbers.pop(str(block_id), None)
+        if doc is None:
+            return
+        self.removed.append(doc)
+        self.total_length -= self.doc_lengths[doc]
     
-    return 'unknown'
+    def search(self, query: str, language: Optional[str] = None, limit: int = 10,
+               after: Optional[Tuple[float, Any]] = None) -> List[Tuple[Any, float]]:
+        """Return (block id, BM25 score) pairs ranked by score, optionally after a cursor.
+        
+        Each query term's postings are scored as whole numpy arrays into a
+        dense score vector, so cost is a few vector operations per term rather
+        than a Python step per posting.
+        """
+        total_docs = len(self.doc_numbers)
+        if not total_docs:
+            return []
+        allowed = None
+        if language:
+            allowed = self.language_bitmaps.get(language)
+            if allowed is None:
+                return []
+        
+        avg_length = self.total_length / total_docs
+        k1, b = self.k1, self.b
+        # Copies, so no buffer export outlives the call and blocks later appends
+        lengths = numpy.array(self.doc_lengths, dtype=numpy.float64)
+        postings = [self.postings[token] for token in set(tokenize(query)) if token in self.postings]
+        if not postings:
+            return []
+        scores = numpy.zeros(len(self.block_ids))
+        for posting in postings:
+            docs = numpy.array(posting[0], dtype=numpy.intp)
+            tf = numpy.array(posting[1], dtype=numpy.float64)
+            df = len(docs)
+            idf = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+            norm = k1 * (1 - b + b * lengths[docs] / avg_length)
+            # A doc appears once per posting list, so fancy-index += is safe
+            scores[docs] += idf * tf * (k1 + 1) / (tf + norm)
+        
+        if allowed is not None:
+            bits = numpy.unpackbits(numpy.frombuffer(bytes(allowed), dtype=numpy.uint8), bitorder='little')
+            scores[:min(len(bits), len(scores))] *= bits[:len(scores)]
+            scores[len(bits):] = 0
+        if self.removed:
+            scores[numpy.array(self.removed, dtype=numpy.intp)] = 0
+        candidates = numpy.flatnonzero(scores)
+        return top_ranked(self.block_ids, self.id_keys, candidates, scores[candidates], limit, after)
 
-def extract_tags(code: str, description: str) -> List[str]:
-    """Extract relevant tags from code and description"""
-    tags = set()
-    
-    # Common programming terms
-    programming_terms = {
-        'api', 'rest', 'database', 'sql', 'react', 'component', 'function',
-        'class', 'authentication', 'auth', 'login', 'user', 'crud', 'form',
-        'validation', 'email', 'password', 'dashboard', 'admin', 'frontend',
-        'backend', 'server', 'client', 'http', 'json', 'xml', 'csv',
-        'file', 'upload', 'download', 'image', 'video', 'search', 'filter',
-        'sort', 'pagination', 'chart', 'graph', 'table', 'list', 'menu',
-        'navbar', 'sidebar', 'modal', 'popup', 'notification', 'alert',
-        'formatter', 'parser', 'validator', 'mapper', 'helper', 'utility'
+search_index = InvertedIndex()
+
+async def sync_index(index: Any, columns: str,
+                     add_rows: Callable[[List[asyncpg.Record]], Awaitable[None]]):
+    """Bring an in-process index up to date with code_blocks.
+    
+    The first call passes every row to add_rows; later calls drop blocks
+    deleted since the last sync and pass rows inserted since then, in batches
+    of 500. Progress is the xmin of a snapshot taken before reading: every
+    transaction below it had finished, so anything committed later has a
+    created_xid (or deleted_xid) at or above it. The reads that follow see at
+    least that snapshot; rows at or above xmin are read again next time, so
+    add must ignore blocks already indexed.
+    """
+    async with acquire_connection() as conn:
+        async with conn.transaction():
+            xmin = await conn.fetchval("SELECT pg_snapshot_xmin(pg_current_snapshot())")
+            if index.synced_xmin is None:
+                cursor = conn.cursor(f"SELECT {columns} FROM code_blocks")
+            else:
+                for row in await conn.fetch("SELECT id FROM code_block_deletions WHERE deleted_xid >= $1",
+                                            index.synced_xmin):
+                    index.remove(row['id'])
+                cursor = conn.cursor(f"SELECT {columns} FROM code_blocks WHERE created_xid >= $1",
+                                     index.synced_xmin)
+            batch = []
+            async for row in cursor:
+                batch.append(row)
+                if len(batch) >= 500:
+                    await add_rows(batch)
+                    batch = []
+                    # Indexing is CPU-bound; let other requests run between batches
+                    await asyncio.sleep(0)
+            if batch:
+                await add_rows(batch)
+    index.synced_xmin = xmin
+
+async def run_index_refresher(refresh: Callable[[], Awaitable[None]], name: str):
+    """Re-run an index refresh every SEARCH_INDEX_REFRESH_SECONDS to pick up
+    writes and deletions from other replicas"""
+    while True:
+        try:
+            await refresh()
+        except Exception as e:
+            print(f"{name} refresh failed: {e}")
+        await asyncio.sleep(SEARCH_INDEX_REFRESH_SECONDS)
+
+async def refresh_search_index():
+    """Sync the BM25 index with code_blocks (initial call builds the index)"""
+    async def add_rows(rows: List[asyncpg.Record]):
+        for row in rows:
+            search_index.add(row['id'], row['code'], row['description'],
+                             row['language'], list(row['tags'] or []))
+    
+    await sync_index(search_index, "id, code, description, language, tags", add_rows)
+    search_index.ready = True
+
+# Near-duplicate detection
+_SHINGLE_TOKEN_RE = re.compile(r'\.?[A-Za-z_]\w*|\d+|\S')
+# Identifiers kept verbatim when canonicalizing variable names for shingling
+_SHINGLE_KEYWORDS = frozenset({
+    'if', 'else', 'elif', 'for', 'while', 'do', 'return', 'def', 'class', 'function',
+    'fn', 'func', 'let', 'const', 'var', 'mut', 'import', 'from', 'export', 'async',
+    'await', 'try', 'except', 'catch', 'finally', 'throw', 'raise', 'new', 'this',
+    'self', 'true', 'false', 'True', 'False', 'None', 'null', 'nil', 'in', 'of',
+    'and', 'or', 'not', 'is', 'with', 'as', 'pass', 'break', 'continue', 'yield',
+    'lambda', 'public', 'private', 'static', 'void', 'int', 'string', 'package',
+    'select', 'where', 'insert', 'update', 'delete', 'SELECT', 'FROM', 'WHERE',
+})
+# Rotation constant used to densify empty one-permutation-hashing bins
+_MINHASH_DENSIFY_OFFSET = 0x9E3779B1
+
+def code_shingles(code: str) -> set:
+    """64-bit hashes of token k-shingles with local variable names canonicalized.
+    
+    Identifiers that are not keywords, attributes or called names are replaced
+    by their order of first appearance, so consistently renamed variables
+    produce the same shingles.
+    """
+    tokens = _SHINGLE_TOKEN_RE.findall(code, 0, MINHASH_MAX_CHARS)
+    names: Dict[str, str] = {}
+    canonical = []
+    for index, token in enumerate(tokens):
+        if ((token[0].isalpha() or token[0] == '_') and token not in _SHINGLE_KEYWORDS
+                and (index + 1 == len(tokens) or tokens[index + 1] != '(')):
+            token = names.setdefault(token, f'${len(names)}')
+        canonical.append(token)
+    
+    size = SHINGLE_SIZE
+    return {
+        int.from_bytes(hashlib.blake2b(' '.join(canonical[i:i + size]).encode(), digest_size=8).digest(), 'little')
+        for i in range(max(1, len(canonical) - size + 1))
     }
+
+def minhash_signature(code: str) -> bytes:
+    """MINHASH_SIZE x 32-bit MinHash signature via densified one-permutation hashing"""
+    empty = 0xFFFFFFFF
+    bins = [empty] * MINHASH_SIZE
+    for shingle in code_shingles(code):
+        slot = shingle % MINHASH_SIZE
+        value = shingle >> 32
+        if value < bins[slot]:
+            bins[slot] = value
+    # Fill empty bins from the next non-empty bin to the right (rotation densification)
+    if empty in bins and any(value != empty for value in bins):
+        filled = list(bins)
+        for slot, value in enumerate(bins):
+            distance = 1
+            while value == empty:
+                value = bins[(slot + distance) % MINHASH_SIZE]
+                if value != empty:
+                    value = (value + distance * _MINHASH_DENSIFY_OFFSET) & empty
+                    break
+                distance += 1
+            filled[slot] = value
+        bins = filled
+    return array('I', bins).tobytes()
+
+class NearDuplicateIndex:
+    """LSH band index over MinHash signatures"""
+    
+    def __init__(self, size: int, bands: int):
+        self.size = size
+        self.bands = bands
+        self.rows = size // bands
+        self.ready = False
+        self.block_ids: List[Any] = []
+        self.doc_numbers: Dict[str, int] = {}
+        self.signatures = array('I')
+        # hash of (band, band values) -> doc number, or array of doc numbers on collision
+        self.buckets: Dict[int, Any] = {}
+        # Doc numbers of removed blocks; their bucket entries stay until a rebuild
+        self.removed = set()
+        self.synced_xmin: Optional[int] = None
+    
+    def __len__(self) -> int:
+        return len(self.doc_numbers)
+    
+    def _band_keys(self, signature: bytes) -> List[int]:
+        width = self.rows * 4
+        return [hash((band, signature[band * width:(band + 1) * width])) for band in range(self.bands)]
+    
+    def add(self, block_id: Any, signature: bytes):
+        """Index a block's signature; blocks already present are ignored"""
+        if str(block_id) in self.doc_numbers:
+            return
+        doc = len(self.block_ids)
+        self.block_ids.append(block_id)
+        self.doc_numbers[str(block_id)] = doc
+        self.signatures.frombytes(signature)
+        for key in self._band_keys(signature):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                self.buckets[key] = doc
+            elif isinstance(bucket, int):
+                self.buckets[key] = array('I', (bucket, doc))
+            else:
+                bucket.append(doc)
+    
+    def remove(self, block_id: Any):
+        """Drop a deleted block from query results; unknown ids are ignored"""
+        doc = self.doc_numbers.pop(str(block_id), None)
+        if doc is not None:
+            self.removed.add(doc)
+    
+    def signature_of(self, block_id: str) -> Optional[bytes]:
+        doc = self.doc_numbers.get(block_id)
+        if doc is None:
+            return None
+        return self.signatures[doc * self.size:(doc + 1) * self.size].tobytes()
+    
+    def query(self, signature: bytes, threshold: float, limit: int = 10,
+              exclude: Optional[str] = None) -> List[Tuple[Any, float]]:
+        """Blocks whose estimated Jaccard similarity is at least threshold, best first"""
+        candidates = set()
+        for key in self._band_keys(signature):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                continue
+            if isinstance(bucket, int):
+                candidates.add(bucket)
+            else:
+                candidates.update(bucket)
+        candidates -= self.removed
+        
+        values = array('I', signature)
+        size = self.size
+        matches = []
+        for doc in candidates:
+            if exclude is not None and str(self.block_ids[doc]) == exclude:
+                continue
+            other = self.signatures[doc * size:(doc + 1) * size]
+            similarity = sum(1 for a, b in zip(values, other) if a == b) / size
+            if similarity >= threshold:
+                matches.append((self.block_ids[doc], similarity))
+        matches.sort(key=lambda match: match[1], reverse=True)
+        return matches[:limit]
+
+near_duplicate_index = NearDuplicateIndex(MINHASH_SIZE, LSH_BANDS)
+
+async def refresh_near_duplicate_index():
+    """Sync the near-duplicate index with code_blocks, computing missing signatures"""
+    async def add_rows(rows: List[asyncpg.Record]):
+        backfill: List[Tuple[str, bytes]] = []
+        for row in rows:
+            signature = row['minhash']
+            if signature is None:
+                # Rows stored before signatures existed
+                signature = minhash_signature(row['code'])
+                backfill.append((row['hash'], signature))
+            near_duplicate_index.add(row['id'], signature)
+        if backfill:
+            async with acquire_connection() as conn:
+                await conn.execute("""
+                    UPDATE code_blocks SET minhash = u.minhash
+                    FROM unnest($1::text[], $2::bytea[]) AS u(hash, minhash)
+                    WHERE code_blocks.hash = u.hash
+                """, [code_hash for code_hash, _ in backfill], [signature for _, signature in backfill])
+    
+    await sync_index(near_duplicate_index,
+                     "id, hash, minhash, CASE WHEN minhash IS NULL THEN code END AS code", add_rows)
+    near_duplicate_index.ready = True
+
+# Semantic search
+# Weight of each character trigram relative to its word (lets "debouncing" meet "debounce")
+_TRIGRAM_WEIGHT = 0.3
+_embedding_model = None
+
+def _load_embedding_model():
+    """Load the sentence-transformers model named by EMBEDDING_MODEL (once per process)"""
+    global _embedding_model
+    if _embedding_model is None:
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise RuntimeError(f"EMBEDDING_MODEL={EMBEDDING_MODEL} requires the 'sentence-transformers' package")
+        _embedding_model = SentenceTransformer(EMBEDDING_MODEL, device='cpu')
+    return _embedding_model
+
+def embedding_dim() -> int:
+    """Dimension of the vectors produced by embed_texts"""
+    if EMBEDDING_MODEL == 'hashing':
+        return EMBEDDING_DIM
+    return _load_embedding_model().get_sentence_embedding_dimension()
+
+def embedding_text(code: str, description: str, tags: List[str]) -> str:
+    """Text given to the model for a block: description and tags first, then the start of the code"""
+    return f"{description or ''}\n{' '.join(tags or [])}\n{(code or '')[:EMBEDDING_MAX_CHARS]}"
+
+def hashing_embedding(code: str, description: str, tags: List[str]) -> bytes:
+    """Deterministic L2-normalized float32 embedding via signed feature hashing of
+    tokens and their character trigrams, weighted by field like the BM25 index"""
+    fields = {'description': description or '', 'tags': ' '.join(tags or []),
+              'code': (code or '')[:EMBEDDING_MAX_CHARS]}
+    counts: Dict[str, int] = {}
+    for name, field_weight in InvertedIndex.FIELD_WEIGHTS:
+        for token in tokenize(fields[name]):
+            counts[token] = counts.get(token, 0) + field_weight
+    
+    vector = [0.0] * EMBEDDING_DIM
+    for token, count in counts.items():
+        weight = 1 + math.log(count)
+        features = [(token, weight)]
+        if len(token) > 4:
+            features.extend((f'#{token[i:i + 3]}', weight * _TRIGRAM_WEIGHT) for i in range(len(token) - 2))
+        for feature, feature_weight in features:
+            # crc32 rather than hash(): embeddings are stored and must not vary per process
+            h = zlib.crc32(feature.encode())
+            vector[h % EMBEDDING_DIM] += feature_weight if h & 0x80000000 else -feature_weight
+    
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm:
+        vector = [value / norm for value in vector]
+    return array('f', vector).tobytes()
+
+def embed_items(items: List[Tuple[str, str, List[str]]]) -> List[bytes]:
+    """Embed a batch of (code, description, tags) items (safe to run in a worker process)"""
+    if EMBEDDING_MODEL == 'hashing':
+        return [hashing_embedding(*item) for item in items]
+    vectors = _load_embedding_model().encode(
+        [embedding_text(*item) for item in items], normalize_embeddings=True, convert_to_numpy=True)
+    return [vector.astype('float32').tobytes() for vector in vectors]
+
+async def compute_embeddings(items: List[Tuple[str, str, List[str]]]) -> List[bytes]:
+    """Embed (code, description, tags) items without stalling the event loop;
+    queries are embedded as a description"""
+    if EMBEDDING_MODEL != 'hashing':
+        # Keep the model in this process; inference releases the GIL
+        return await asyncio.to_thread(embed_items, items)
+    chars = sum(min(len(code), EMBEDDING_MAX_CHARS) + len(description) for code, description, _ in items)
+    return await run_analysis(embed_items, items, chars)
+
+def _spherical_kmeans(vectors: "numpy.ndarray", lists: int,
+                      iterations: int = 10) -> Tuple["numpy.ndarray", "numpy.ndarray"]:
+    """Cluster unit vectors by cosine similarity; returns (centroids, assignment per vector)"""
+    rng = numpy.random.default_rng(0)
+    sample = vectors
+    if len(vectors) > lists * 256:
+        sample = vectors[rng.choice(len(vectors), lists * 256, replace=False)]
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assigned = numpy.argmax(sample @ centroids.T, axis=1)
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, assigned, sample)
+        norms = numpy.linalg.norm(sums, axis=1)
+        # Empty clusters keep their previous centroid
+        nonempty = norms > 0
+        centroids[nonempty] = sums[nonempty] / norms[nonempty, None]
+    
+    assignments = numpy.empty(len(vectors), dtype=numpy.int32)
+    for start in range(0, len(vectors), 65536):
+        assignments[start:start + 65536] = numpy.argmax(vectors[start:start + 65536] @ centroids.T, axis=1)
+    return centroids, assignments
+
+class VectorIndex:
+    """IVF (inverted file) index over L2-normalized float32 embeddings.
+    
+    Small collections, and small language subsets, are scanned exactly; larger
+    ones only score the vectors in the nprobe clusters nearest the query.
+    """
+    
+    def __init__(self, nprobe: int, min_cluster_size: int):
+        self.nprobe = nprobe
+        self.min_cluster_size = min_cluster_size
+        self.ready = False
+        self.dim: Optional[int] = None
+        self.block_ids: List[Any] = []
+        self.doc_numbers: Dict[str, int] = {}
+        # id_sort_key halves per doc number, for tie-breaking
+        self.id_keys = array('Q')
+        # Rows [:len(self.block_ids)] are in use; capacity doubles as blocks are added
+        self.vectors: Optional["numpy.ndarray"] = None
+        self.language_codes: Optional["numpy.ndarray"] = None
+        self.languages: Dict[str, int] = {}
+        self.centroids: Optional["numpy.ndarray"] = None
+        self.assignments: Optional["numpy.ndarray"] = None
+        self.clustered_size = 0
+        # Doc numbers of removed blocks; their vectors stay until a rebuild
+        self.removed = array('I')
+        self.synced_xmin: Optional[int] = None
+    
+    def __len__(self) -> int:
+        return len(self.doc_numbers)
+    
+    def _grow(self, capacity: int):
+        vectors = numpy.zeros((capacity, self.dim), dtype=numpy.float32)
+        language_codes = numpy.zeros(capacity, dtype=numpy.int32)
+        assignments = numpy.zeros(capacity, dtype=numpy.int32)
+        size = len(self.block_ids)
+        if self.vectors is not None:
+            vectors[:size] = self.vectors[:size]
+            language_codes[:size] = self.language_codes[:size]
+            assignments[:size] = self.assignments[:size]
+        self.vectors, self.language_codes, self.assignments = vectors, language_codes, assignments
+    
+    def add(self, block_id: Any, embedding: bytes, language: str):
+        """Index a block's embedding; blocks already present are ignored"""
+        if str(block_id) in self.doc_numbers:
+            return
+        vector = numpy.frombuffer(embedding, dtype=numpy.float32)
+        if self.dim is None:
+            self.dim = len(vector)
+        elif len(vector) != self.dim:
+            return
+        doc = len(self.block_ids)
+        if self.vectors is None or doc == len(self.vectors):
+            self._grow(max(1024, 2 * doc))
+        self.vectors[doc] = vector
+        self.language_codes[doc] = self.languages.setdefault(language or 'unknown', len(self.languages))
+        if self.centroids is not None:
+            self.assignments[doc] = numpy.argmax(self.centroids @ vector)
+        self.block_ids.append(block_id)
+        self.doc_numbers[str(block_id)] = doc
+        self.id_keys.extend(id_sort_key(block_id))
+    
+    def remove(self, block_id: Any):
+        """Drop a deleted block from search results; unknown ids are ignored"""
+        doc = self.doc_numbers.pop(str(block_id), None)
+        if doc is not None:
+            self.removed.append(doc)
+    
+    def needs_clustering(self) -> bool:
+        size = len(self.block_ids)
+        return size >= self.min_cluster_size and size >= 2 * self.clustered_size
+    
+    async def cluster(self):
+        """(Re)build the IVF clusters off the event loop (about sqrt(n) clusters)"""
+        size = len(self.block_ids)
+        lists = min(4096, max(16, int(math.sqrt(size))))
+        snapshot = self.vectors[:size].copy()
+        centroids, assignments = await asyncio.to_thread(_spherical_kmeans, snapshot, lists)
+        # Blocks added while clustering ran were assigned with the old centroids
+        for doc in range(size, len(self.block_ids)):
+            self.assignments[doc] = numpy.argmax(centroids @ self.vectors[doc])
+        self.assignments[:size] = assignments
+        self.centroids = centroids
+        self.clustered_size = size
+    
+    def search(self, embedding: bytes, language: Optional[str] = None, limit: int = 10,
+               after: Optional[Tuple[float, Any]] = None) -> List[Tuple[Any, float]]:
+        """Return (block id, cosine similarity) pairs ranked by similarity, optionally after a cursor"""
+        size = len(self.block_ids)
+        query = numpy.frombuffer(embedding, dtype=numpy.float32)
+        if not size or len(query) != self.dim:
+            return []
+        
+        if language:
+            code = self.languages.get(language)
+            if code is None:
+                return []
+            candidates = numpy.flatnonzero(self.language_codes[:size] == code)
+        else:
+            candidates = numpy.arange(size)
+        if self.centroids is not None and len(candidates) > self.min_cluster_size:
+            nprobe = min(self.nprobe, len(self.centroids))
+            probed = numpy.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            candidates = candidates[numpy.isin(self.assignments[candidates], probed)]
+        if self.removed:
+            candidates = candidates[~numpy.isin(candidates, numpy.array(self.removed, dtype=candidates.dtype))]
+        scores = self.vectors[candidates] @ query
+        return top_ranked(self.block_ids, self.id_keys, candidates, scores, limit, after)
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "blocks": len(self.doc_numbers),
+            "dim": self.dim,
+            "clusters": 0 if self.centroids is None else len(self.centroids),
+            "nprobe": self.nprobe,
+        }
+
+vector_index = VectorIndex(SEMANTIC_NPROBE, SEMANTIC_IVF_MIN_SIZE)
+
+async def refresh_vector_index():
+    """Sync the vector index with code_blocks, computing missing embeddings"""
+    dim = await asyncio.to_thread(embedding_dim)
+    columns = f"""id, hash, language, embedding,
+        CASE WHEN embedding IS NULL OR length(embedding) <> {dim * 4} THEN description END AS description,
+        CASE WHEN embedding IS NULL OR length(embedding) <> {dim * 4} THEN tags END AS tags,
+        CASE WHEN embedding IS NULL OR length(embedding) <> {dim * 4} THEN code END AS code"""
+    
+    async def add_rows(rows: List[asyncpg.Record]):
+        # Rows stored before embeddings existed, or by a different model
+        pending = [row for row in rows if row['embedding'] is None or len(row['embedding']) != dim * 4]
+        for row in rows:
+            if row['embedding'] is not None and len(row['embedding']) == dim * 4:
+                vector_index.add(row['id'], row['embedding'], row['language'])
+        if not pending:
+            return
+        embeddings = await compute_embeddings([
+            (row['code'], row['description'], list(row['tags'] or [])) for row in pending
+        ])
+        async with acquire_connection() as conn:
+            await conn.execute("""
+                UPDATE code_blocks SET embedding = u.embedding
+                FROM unnest($1::text[], $2::bytea[]) AS u(hash, embedding)
+                WHERE code_blocks.hash = u.hash
+            """, [row['hash'] for row in pending], embeddings)
+        for row, embedding in zip(pending, embeddings):
+            vector_index.add(row['id'], embedding, row['language'])
+    
+    await sync_index(vector_index, columns, add_rows)
+    if vector_index.needs_clustering():
+        await vector_index.cluster()
+    vector_index.ready = True
+
+# Search result cache
+class SearchCache:
+    """In-process LRU/TTL cache of serialized search responses"""
+    
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self.generation = 0
+        # Wall-clock time of the last invalidation, comparable across replicas
+        self.invalidated_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    async def snapshot(self) -> Tuple[int, float]:
+        """Current generation and last invalidation time, taken before reading a page to cache"""
+        return self.generation, self.invalidated_at
     
-    # Extract from description
-    desc_words = re.findall(r'\b\w+\b', description.lower())
-    for word in desc_words:
-        if word in programming_terms:
-            tags.add(word)
+    async def set(self, key: str, value: bytes, generation: Optional[int] = None):
+        # A page read before the last invalidation must not be stored after it
+        if self.max_entries <= 0 or (generation is not None and generation != self.generation):
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
     
-    # Extract from code
-    code_words = re.findall(r'\b\w+\b', code.lower())
-    for word in code_words:
-        if word in programming_terms:
-            tags.add(word)
+    async def invalidate(self):
+        """Drop every cached response (called when new blocks are stored)"""
+        self.generation += 1
+        self.invalidated_at = time.time()
+        self.entries.clear()
     
-    # Language-specific patterns
-    if 'function' in code.lower() or 'def ' in code:
-        tags.add('function')
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "memory",
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "generation": self.generation,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class RedisSearchCache(SearchCache):
+    """Search cache shared by all replicas through a Redis-compatible server"""
+    
+    GENERATION_KEY = 'code_blocks:search:generation'
+    INVALIDATED_AT_KEY = 'code_blocks:search:invalidated_at'
+    
+    def __init__(self, url: str, ttl: float):
+        super().__init__(0, ttl)
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("SEARCH_CACHE_URL requires the 'redis' package")
+        self.client = redis.from_url(url)
+        self.errors = 0
+    
+    async def _key(self, key: str, generation: Optional[int] = None) -> str:
+        # Entries are namespaced by the shared generation, so a bump invalidates everywhere
+        if generation is None:
+            generation = await self.client.get(self.GENERATION_KEY)
+            self.generation = generation = int(generation or 0)
+        return f"code_blocks:search:{generation}:{key}"
+    
+    async def snapshot(self) -> Tuple[int, float]:
+        try:
+            generation, invalidated_at = await self.client.mget(self.GENERATION_KEY, self.INVALIDATED_AT_KEY)
+            self.generation = int(generation or 0)
+            self.invalidated_at = float(invalidated_at or 0)
+        except Exception:
+            self.errors += 1
+        return self.generation, self.invalidated_at
     
-    if 'class ' in code:
-        tags.add('class')
+    async def get(self, key: str) -> Optional[bytes]:
+        try:
+            value = await self.client.get(await self._key(key))
+        except Exception:
+            self.errors += 1
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
     
-    if 'async' in code or 'await' in code:
-        tags.add('async')
+    async def set(self, key: str, value: bytes, generation: Optional[int] = None):
+        # Stored under the generation the page was read in, which nobody reads once bumped
+        try:
+            await self.client.set(await self._key(key, generation), value, ex=max(1, int(self.ttl)))
+        except Exception:
+            self.errors += 1
     
-    if 'export' in code:
-        tags.add('module')
+    async def invalidate(self):
+        try:
+            now = time.time()
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.incr(self.GENERATION_KEY)
+                pipe.set(self.INVALIDATED_AT_KEY, now)
+                self.generation, _ = await pipe.execute()
+            self.invalidated_at = now
+        except Exception:
+            self.errors += 1
     
-    return list(tags)[:10]  # Limit to 10 tags
+    def metrics(self) -> Dict[str, Any]:
+        metrics = super().metrics()
+        metrics.update({"backend": "redis", "entries": None, "max_entries": None,
+                        "evictions": None, "errors": self.errors})
+        return metrics
+
+def search_cache_key(query: str, language: Optional[str], limit: int, mode: str,
+                     cursor: Optional[str], view: str) -> str:
+    """Cache key for a search, folding the query only as far as its mode ignores:
+    fulltext and fuzzy ignore case and runs of whitespace, substring ignores
+    case, and ilike (case-sensitive tag match, whitespace in the pattern),
+    semantic and hybrid (embedding models may see case) take it verbatim"""
+    if mode in ('fulltext', 'fuzzy') and re.search(r'\w', query):
+        query = ' '.join(query.split()).lower()
+    elif mode == 'substring':
+        query = query.lower()
+    return json.dumps([query, language, limit, mode, cursor, view], separators=(',', ':'))
+
+if SEARCH_CACHE_URL:
+    search_cache: SearchCache = RedisSearchCache(SEARCH_CACHE_URL, SEARCH_CACHE_TTL_SECONDS)
+else:
+    search_cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL_SECONDS)
 
 # Database operations
-async def store_code_block(block: CodeBlockCreate) -> str:
-    """Store a new code block"""
-    # Generate hash
-    code_hash = hashlib.md5(block.code.encode()).hexdigest()
+# Dedup normalization
+def _quoted(quote: str) -> str:
+    """A one-line string literal with backslash escapes (unterminated: to end of line)"""
+    return rf"{quote}(?:\\[\s\S]|[^{quote}\\\n])*(?:{quote}|$)"
+
+def _multiline_quoted(quote: str) -> str:
+    """A string literal that may span lines (unterminated: to end of input)"""
+    return rf"{quote}(?:\\[\s\S]|[^{quote}\\])*(?:{quote}|\Z)"
+
+def _triple_quoted(quote: str) -> str:
+    return rf"{quote * 3}(?:\\[\s\S]|[^\\])*?(?:{quote * 3}|\Z)"
+
+_C_BLOCK_COMMENT = r"/\*[\s\S]*?\*/"
+# A JS regex literal, recognized by what precedes it so division is not mistaken for one
+_JS_REGEX_LITERAL = (r"(?:[(,=:\[!&|?{};+\-*%<>~^]|\breturn|\btypeof|^)[ \t]*"
+                     r"/(?![/*])(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[a-z]*")
+
+# language -> (literals copied unchanged, line comment marker, block comment).
+# Literals are matched as whole tokens, so comment markers inside strings,
+# templates and regexes are never stripped; unterminated literals run to the
+# end of the line or input, which keeps more rather than less.
+_COMMENT_SYNTAX = {
+    'python': ([_triple_quoted("'"), _triple_quoted('"'), _quoted("'"), _quoted('"')], '#', None),
+    'javascript': ([_quoted("'"), _quoted('"'), _multiline_quoted('`'), _JS_REGEX_LITERAL], '//', _C_BLOCK_COMMENT),
+    'typescript': ([_quoted("'"), _quoted('"'), _multiline_quoted('`'), _JS_REGEX_LITERAL], '//', _C_BLOCK_COMMENT),
+    'java': ([_triple_quoted('"'), _quoted("'"), _quoted('"')], '//', _C_BLOCK_COMMENT),
+    'go': ([_quoted("'"), _quoted('"'), r"`[^`]*(?:`|\Z)"], '//', _C_BLOCK_COMMENT),
+    'rust': ([r'\bb?r(?P<hashes>#*)"[\s\S]*?(?:"(?P=hashes)|\Z)', _multiline_quoted('"'),
+              # A char literal; a lone quote is a lifetime
+              r"'(?:\\(?:u\{[0-9a-fA-F]*\}|x[0-9a-fA-F]{2}|.)|[^\\'\n])'"], '//', _C_BLOCK_COMMENT),
+    'sql': ([r"'(?:''|\\[\s\S]|[^'\\])*(?:'|\Z)", r'"(?:""|[^"])*(?:"|\Z)',
+             r"\$(?P<tag>(?:[A-Za-z_]\w*)?)\$[\s\S]*?(?:\$(?P=tag)\$|\Z)"], '--', _C_BLOCK_COMMENT),
+    'css': ([_quoted("'"), _quoted('"'), r"\burl\([^)\"']*\)"], None, _C_BLOCK_COMMENT),
+    'html': ([r"<(?P<raw>script|style)\b[\s\S]*?(?:</(?P=raw)\s*>|\Z)",
+              r"""<(?!!--)[A-Za-z/!?][^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>?"""], None, r"<!--[\s\S]*?-->"),
+}
+
+def _comment_token_re(literals: List[str], line_marker: Optional[str], block: Optional[str]) -> "re.Pattern":
+    """Tokenizer whose 'drop' group is a removable comment and 'keep' group a
+    token copied unchanged (a literal, or a comment that follows code)"""
+    drop, keep = [], list(literals)
+    if line_marker:
+        drop.append(rf"^[ \t]*{re.escape(line_marker)}[^\n]*(?:\n|\Z)")
+        keep.append(rf"{re.escape(line_marker)}[^\n]*")
+    if block:
+        drop.append(block)
+    return re.compile(f"(?P<drop>{'|'.join(drop)})|(?P<keep>{'|'.join(keep)})", re.M)
+
+_COMMENT_TOKEN_RE = {language: _comment_token_re(*syntax) for language, syntax in _COMMENT_SYNTAX.items()}
+
+def strip_comments(code: str, language: str) -> str:
+    """Remove block comments and whole-line comments, leaving literals intact"""
+    pattern = _COMMENT_TOKEN_RE.get(language)
+    if pattern is None:
+        return code
+    return pattern.sub(lambda match: match.group('keep') or '', code)
+
+def normalize_code(code: str, language: str) -> str:
+    """Canonicalize code before hashing according to DEDUP_NORMALIZE.
     
+    Steps: 'line_endings' (CRLF/CR -> LF), 'trailing_whitespace' (per line, plus
+    leading/trailing blank lines), 'indentation' (tabs -> 4 spaces, common
+    indent removed) and 'comments' (block comments and whole-line comments for
+    the block's language, see strip_comments; comments sharing a line with
+    code are kept, and so is anything inside a string or regex literal).
+    """
+    if 'line_endings' in DEDUP_NORMALIZE:
+        code = code.replace('\r\n', '\n').replace('\r', '\n')
+    if 'comments' in DEDUP_NORMALIZE:
+        code = strip_comments(code, language)
+    if 'indentation' in DEDUP_NORMALIZE:
+        code = textwrap.dedent(code.expandtabs(4))
+    if 'trailing_whitespace' in DEDUP_NORMALIZE:
+        code = '\n'.join(line.rstrip() for line in code.split('\n')).strip('\n')
+    return code
+
+def _xxh3_128(data: bytes) -> str:
+    if xxhash is None:
+        raise RuntimeError("HASH_ALGORITHM=xxh3 requires the 'xxhash' package")
+    return xxhash.xxh3_128_hexdigest(data)
+
+# Content hash functions; all produce 32 hex characters
+HASH_FUNCTIONS = {
+    'md5': lambda data: hashlib.md5(data).hexdigest(),
+    'blake2b': lambda data: hashlib.blake2b(data, digest_size=16).hexdigest(),
+    'xxh3': _xxh3_128,
+}
+
+def hash_code(code: str, language: str) -> str:
+    """Dedup hash of code after normalization"""
+    return HASH_FUNCTIONS[HASH_ALGORITHM](normalize_code(code, language).encode())
+
+def analyze_code(code: str, description: str, language: str,
+                 tags: List[str]) -> Tuple[str, str, List[str], Optional[bytes]]:
+    """Hash code, fill in language and tags if missing and compute the MinHash
+    signature (safe to run in a worker process)"""
     # Auto-detect language if not provided
-    if not block.language or block.language == 'auto':
-        block.language = detect_language(block.code)
+    if not language or language == 'auto':
+        language = detect_language(code)
     
     # Auto-extract tags if not provided
-    if not block.tags:
-        block.tags = extract_tags(block.code, block.description)
-    
-    async with db_pool.acquire() as conn:
-        # Check if block already exists
-        existing = await conn.fetchrow(
-            "SELECT id FROM code_blocks WHERE hash = $1",
-            code_hash
-        )
-        
-        if existing:
-            # Update usage count
-            await conn.execute(
-                "UPDATE code_blocks SET usage_count = usage_count + 1 WHERE hash = $1",
-                code_hash
-            )
-            return str(existing['id'])
-        
-        # Insert new block
-        block_id = await conn.fetchval("""
-            INSERT INTO code_blocks (hash, code, description, language, tags, usage_count, success_rate)
-            VALUES ($1, $2, $3, $4, $5, $6, $7)
-            RETURNING id
-        """, code_hash, block.code, block.description, block.language, 
-            block.tags, 0, 1.0)
-        
-        return str(block_id)
-
-async def search_code_blocks(query: str, language: Optional[str] = None, limit: int = 10) -> List[CodeBlockResponse]:
-    """Search for code blocks"""
-    search_conditions = []
-    params = []
-    param_count = 1
-    
-    # Text search
-    if query:
-        search_conditions.append(f"""
-            (description ILIKE ${param_count} OR 
-             code ILIKE ${param_count} OR 
-             ${param_count} = ANY(tags))
-        """)
-        params.append(f"%{query}%")
-        param_count += 1
+    if not tags:
+        tags = extract_tags(code, description)
+    
+    # Hash the normalized code (comment stripping depends on the language)
+    code_hash = hash_code(code, language)
+    
+    signature = minhash_signature(code) if NEAR_DUP_POLICY != 'off' else None
+    
+    return code_hash, language, tags, signature
+
+def analyze_codes(items: List[Tuple[str, str, str, List[str]]]) -> List[Tuple[str, str, List[str], Optional[bytes]]]:
+    """Run analyze_code over a batch"""
+    return [analyze_code(*item) for item in items]
+
+async def run_analysis(batch_func, items: List[Any], chars: int) -> List[Any]:
+    """Run batch_func over items, in the analysis executor when there is a lot of input.
+    
+    Batches of at least ANALYSIS_OFFLOAD_CHARS characters are split across the
+    executor's workers so large pastes do not stall the event loop.
+    """
+    if analysis_executor is None or chars < ANALYSIS_OFFLOAD_CHARS:
+        return batch_func(items)
+    loop = asyncio.get_running_loop()
+    size = -(-len(items) // ANALYSIS_WORKERS)
+    chunks = await asyncio.gather(*(
+        loop.run_in_executor(analysis_executor, batch_func, items[start:start + size])
+        for start in range(0, len(items), size)
+    ))
+    return [result for chunk in chunks for result in chunk]
+
+async def prepare_code_blocks(blocks: List[CodeBlockCreate]) -> List[Tuple[str, Optional[bytes]]]:
+    """Fill in language and tags if missing and return each block's (hash, MinHash signature)"""
+    items = [(block.code, block.description, block.language, block.tags) for block in blocks]
+    results = await run_analysis(analyze_codes, items, sum(len(block.code) for block in blocks))
     
-    # Language filter
+    prepared = []
+    for block, (code_hash, language, tags, signature) in zip(blocks, results):
+        block.language = language
+        block.tags = tags
+        prepared.append((code_hash, signature))
+    return prepared
+
+async def embed_blocks(blocks: List[CodeBlockCreate]) -> List[Optional[bytes]]:
+    """Embeddings for prepared blocks (None when semantic search is disabled)"""
+    if not SEMANTIC_SEARCH:
+        return [None] * len(blocks)
+    return await compute_embeddings([(block.code, block.description, block.tags) for block in blocks])
+
+_COUNT_REUSE = register_statement('count_reuse', """
+    UPDATE code_blocks SET usage_count = usage_count + 1 WHERE id = $1 RETURNING id
+""")
+
+# Insert, or count a reuse of an existing block, in one statement
+_UPSERT_BLOCK = register_statement('upsert_block', """
+    INSERT INTO code_blocks (hash, code, description, language, tags, usage_count, success_rate, minhash, embedding)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+    ON CONFLICT (hash) DO UPDATE SET usage_count = code_blocks.usage_count + 1
+    RETURNING id, (xmax = 0) AS inserted
+""")
+
+class UsageBuffer:
+    """Write-behind buffer of usage_count increments, keyed by block hash"""
+    
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self.pending: Dict[str, int] = {}
+        self.pending_total = 0
+        self.flush_needed = asyncio.Event()
+        # Serializes flushes so shutdown waits for one already in flight
+        self.lock = asyncio.Lock()
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+    
+    def increment(self, code_hash: str, count: int = 1):
+        self.pending[code_hash] = self.pending.get(code_hash, 0) + count
+        self.pending_total += count
+        if self.pending_total >= self.max_pending:
+            self.flush_needed.set()
+    
+    async def flush(self):
+        """Apply all pending increments in one UPDATE; on failure they stay pending"""
+        async with self.lock:
+            if not self.pending:
+                return
+            pending, self.pending, self.pending_total = self.pending, {}, 0
+            # Hash order keeps row locks consistent with the bulk merge
+            hashes = sorted(pending)
+            try:
+                async with acquire_connection() as conn:
+                    await conn.execute("""
+                        UPDATE code_blocks SET usage_count = code_blocks.usage_count + u.hits
+                        FROM unnest($1::text[], $2::integer[]) AS u(hash, hits)
+                        WHERE code_blocks.hash = u.hash
+                    """, hashes, [pending[code_hash] for code_hash in hashes])
+            except BaseException:
+                self.failures += 1
+                # Put the counts back without re-triggering an immediate retry
+                for code_hash, count in pending.items():
+                    self.pending[code_hash] = self.pending.get(code_hash, 0) + count
+                self.pending_total += sum(pending.values())
+                raise
+            self.flushes += 1
+            self.flushed += sum(pending.values())
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "pending_blocks": len(self.pending),
+            "pending_increments": self.pending_total,
+            "flushes": self.flushes,
+            "flushed_increments": self.flushed,
+            "failures": self.failures,
+            "known_hashes": len(known_hashes),
+        }
+
+usage_buffer = UsageBuffer(USAGE_FLUSH_MAX_PENDING)
+
+# hash -> id of blocks known to exist, so repeats skip the upsert
+known_hashes: "OrderedDict[str, str]" = OrderedDict()
+
+def remember_hash(code_hash: str, block_id: str):
+    known_hashes[code_hash] = block_id
+    known_hashes.move_to_end(code_hash)
+    while len(known_hashes) > USAGE_HASH_CACHE_SIZE:
+        known_hashes.popitem(last=False)
+
+async def run_usage_flusher():
+    """Flush buffered usage counts every USAGE_FLUSH_SECONDS or when enough are pending"""
+    while True:
+        try:
+            await asyncio.wait_for(usage_buffer.flush_needed.wait(), USAGE_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        usage_buffer.flush_needed.clear()
+        try:
+            # Shielded so cancellation at shutdown never abandons an UPDATE half way
+            await asyncio.shield(usage_buffer.flush())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Usage count flush failed: {e}")
+
+async def store_code_block(block: CodeBlockCreate) -> Tuple[str, bool, List[Tuple[str, float]]]:
+    """Store a code block, returning its id, whether it was newly inserted and
+    any near-duplicates as (id, similarity)"""
+    code_hash, signature = (await prepare_code_blocks([block]))[0]
+    
+    near_duplicates = []
+    if signature is not None and near_duplicate_index.ready:
+        near_duplicates = [
+            (str(block_id), similarity) for block_id, similarity
+            in near_duplicate_index.query(signature, NEAR_DUP_THRESHOLD, NEAR_DUP_MAX_RESULTS)
+        ]
+    
+    known_id = known_hashes.get(code_hash)
+    if known_id is not None:
+        # Exact repeat of a block stored recently: count it without touching the row
+        usage_buffer.increment(code_hash)
+        return known_id, False, [match for match in near_duplicates if match[0] != known_id]
+    
+    if NEAR_DUP_POLICY == 'merge' and near_duplicates:
+        async with acquire_connection() as conn:
+            # Count this as a reuse of the most similar existing block
+            merged_id = await conn.fetchval(STATEMENTS[_COUNT_REUSE], near_duplicates[0][0])
+        if merged_id is not None:
+            return str(merged_id), False, near_duplicates
+    
+    embedding = (await embed_blocks([block]))[0]
+    
+    async with acquire_connection() as conn:
+        row = await conn.fetchrow(STATEMENTS[_UPSERT_BLOCK],
+            code_hash, block.code, block.description, block.language,
+            block.tags, 0, 1.0, signature, embedding)
+    block_id, inserted = row['id'], row['inserted']
+    remember_hash(code_hash, str(block_id))
+    
+    if inserted:
+        await search_cache.invalidate()
+        if MEMORY_SEARCH:
+            search_index.add(block_id, block.code, block.description, block.language, block.tags)
+        if signature is not None:
+            near_duplicate_index.add(block_id, signature)
+        if embedding is not None:
+            vector_index.add(block_id, embedding, block.language)
+    
+    # An exact duplicate is reported through `inserted`, not as a near-duplicate of itself
+    near_duplicates = [match for match in near_duplicates if match[0] != str(block_id)]
+    return str(block_id), inserted, near_duplicates
+
+async def store_code_blocks(blocks: List[CodeBlockCreate]) -> List[Tuple[str, bool]]:
+    """Store many code blocks with one COPY and one merge, returning (id, inserted) per block"""
+    prepared = await prepare_code_blocks(blocks)
+    hashes = [code_hash for code_hash, _ in prepared]
+    
+    # Dedup within the batch; the first occurrence supplies the stored content
+    unique: Dict[str, Tuple[CodeBlockCreate, Optional[bytes], int]] = {}
+    for block, (code_hash, signature) in zip(blocks, prepared):
+        first, first_signature, hits = unique.get(code_hash, (block, signature, 0))
+        unique[code_hash] = (first, first_signature, hits + 1)
+    embeddings = dict(zip(unique, await embed_blocks([block for block, _, _ in unique.values()])))
+    records = [
+        (code_hash, block.code, block.description, block.language, block.tags, signature, embeddings[code_hash], hits)
+        for code_hash, (block, signature, hits) in unique.items()
+    ]
+    
+    async with acquire_connection() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                CREATE TEMP TABLE code_blocks_staging (
+                    hash text, code text, description text, language text, tags text[],
+                    minhash bytea, embedding bytea, hits integer
+                ) ON COMMIT DROP
+            """)
+            await conn.copy_records_to_table('code_blocks_staging', records=records)
+            # Hash order keeps row locks consistent across concurrent merges
+            rows = await conn.fetch("""
+                INSERT INTO code_blocks (hash, code, description, language, tags, usage_count, success_rate, minhash, embedding)
+                SELECT hash, code, description, language, tags, hits - 1, 1.0, minhash, embedding
+                FROM code_blocks_staging
+                ORDER BY hash
+                ON CONFLICT (hash) DO UPDATE
+                    SET usage_count = code_blocks.usage_count + EXCLUDED.usage_count + 1
+                RETURNING hash, id, (xmax = 0) AS inserted
+            """)
+    stored = {row['hash']: (row['id'], row['inserted']) for row in rows}
+    for code_hash, (block_id, _) in stored.items():
+        remember_hash(code_hash, str(block_id))
+    
+    if any(inserted for _, inserted in stored.values()):
+        await search_cache.invalidate()
+    for code_hash, (block_id, inserted) in stored.items():
+        if inserted:
+            block, signature, _ = unique[code_hash]
+            if MEMORY_SEARCH:
+                search_index.add(block_id, block.code, block.description, block.language, block.tags)
+            if signature is not None:
+                near_duplicate_index.add(block_id, signature)
+            if embeddings[code_hash] is not None:
+                vector_index.add(block_id, embeddings[code_hash], block.language)
+    
+    results = []
+    seen = set()
+    for code_hash in hashes:
+        block_id, inserted = stored[code_hash]
+        results.append((str(block_id), inserted and code_hash not in seen))
+        seen.add(code_hash)
+    return results
+
+async def ingest_ndjson_stream(chunks: AsyncIterator[bytes], progress: Dict[str, Any]):
+    """Parse NDJSON incrementally and store it in bounded batches, updating progress"""
+    batch: List[CodeBlockCreate] = []
+    batch_bytes = 0
+    
+    async def flush():
+        nonlocal batch_bytes
+        results = await store_code_blocks(batch)
+        inserted = sum(1 for _, created in results if created)
+        progress['inserted'] += inserted
+        progress['duplicates'] += len(results) - inserted
+        progress['updated_at'] = datetime.utcnow().isoformat()
+        batch.clear()
+        batch_bytes = 0
+    
+    def parse(line: bytes):
+        nonlocal batch_bytes
+        progress['lines'] += 1
+        if not line.strip():
+            return
+        try:
+            batch.append(CodeBlockCreate(**json.loads(line)))
+            batch_bytes += len(line)
+        except (ValueError, TypeError) as e:
+            progress['errors'] += 1
+            if len(progress['error_samples']) < STREAM_MAX_ERROR_SAMPLES:
+                progress['error_samples'].append(f"Line {progress['lines']}: {e}")
+    
+    # Append in place and only scan the new bytes for newlines, so a long
+    # line arriving in many chunks costs linear rather than quadratic time
+    buffer = bytearray()
+    async for chunk in chunks:
+        progress['bytes'] += len(chunk)
+        scan_from = len(buffer)
+        buffer += chunk
+        start = 0
+        end = buffer.find(b'\n', scan_from)
+        while end != -1:
+            parse(bytes(buffer[start:end]))
+            start = end + 1
+            # Awaiting the flush before reading on is the backpressure
+            if len(batch) >= STREAM_BATCH_SIZE or batch_bytes >= STREAM_BATCH_BYTES:
+                await flush()
+            end = buffer.find(b'\n', start)
+        del buffer[:start]
+        if len(buffer) > STREAM_MAX_LINE_BYTES:
+            raise ValueError(f"Line {progress['lines'] + 1} exceeds {STREAM_MAX_LINE_BYTES} bytes")
+    # A trailing newline leaves nothing behind, which is not another line
+    if buffer:
+        parse(bytes(buffer))
+    if batch:
+        await flush()
+
+# LIKE pattern for a literal substring match ('_' and '%' are common in identifiers)
+_LIKE_PATTERN_SQL = r"""'%' || replace(replace(replace($1, '\', '\\'), '%', '\%'), '_', '\_') || '%'"""
+
+# Usage/success boost shared by the ranking expressions
+_POPULARITY_SQL = "(1 + ln(1 + greatest(usage_count, 0))) * (0.5 + 0.5 * success_rate)"
+
+# Popularity as a tie-break for the trigram ranks: at most ~2e-4, below the
+# gap between distinct similarity scores, so it only orders equal matches
+_POPULARITY_TIE_BREAK_SQL = f"1e-5 * {_POPULARITY_SQL}"
+
+# Per-mode (FROM extras, WHERE clause, rank expression); $1 is always the raw query.
+# Results are ordered by (rank, id) descending, which is also the cursor key.
+SEARCH_QUERIES = {
+    'fulltext': (
+        f", websearch_to_tsquery('{FTS_CONFIG}', $1) AS query",
+        "search_vector @@ query",
+        f"ts_rank_cd(search_vector, query, 32) * {_POPULARITY_SQL}",
+    ),
+    'substring': (
+        "",
+        f"(description ILIKE {_LIKE_PATTERN_SQL} OR code ILIKE {_LIKE_PATTERN_SQL})",
+        f"greatest(similarity(description, $1), word_similarity($1, code))::float8 + {_POPULARITY_TIE_BREAK_SQL}",
+    ),
+    'fuzzy': (
+        "",
+        "($1 <% description OR $1 <% code)",
+        f"greatest(word_similarity($1, description), word_similarity($1, code))::float8 + {_POPULARITY_TIE_BREAK_SQL}",
+    ),
+    'ilike': (
+        "",
+        """(description ILIKE '%' || $1 || '%' OR 
+               code ILIKE '%' || $1 || '%' OR 
+               $1 = ANY(tags))""",
+        _POPULARITY_SQL,
+    ),
+}
+
+def encode_cursor(values: Dict[str, Any]) -> str:
+    """Encode keyset values as an opaque URL-safe cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def _cursor_rank(value: Any) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError
+    return float(value)
+
+def _cursor_block_id(value: Any) -> Any:
+    if isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63:
+        return value
+    if isinstance(value, str):
+        return str(uuid.UUID(value))
+    raise ValueError
+
+def _cursor_timestamp(value: Any) -> datetime:
+    if not isinstance(value, str):
+        raise ValueError
+    return datetime.fromisoformat(value)
+
+def _cursor_mode(value: Any) -> str:
+    if not isinstance(value, str):
+        raise ValueError
+    return value
+
+# Cursor key -> converter raising ValueError for a value of the wrong type
+_CURSOR_VALUES = {'rank': _cursor_rank, 'id': _cursor_block_id,
+                  'created_at': _cursor_timestamp, 'mode': _cursor_mode}
+
+def decode_cursor(cursor: str, *keys: str) -> Dict[str, Any]:
+    """Decode a cursor produced by encode_cursor into the expected keys, checking
+    each value's type (created_at comes back as a datetime)"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, dict):
+            raise ValueError
+        return {key: _CURSOR_VALUES[key](values[key]) for key in keys}
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor")
+
+def _cursor_id(block_id: Any) -> Any:
+    """Cursor representation of a primary key (ints stay ints, uuids become strings)"""
+    return block_id if isinstance(block_id, int) else str(block_id)
+
+def _block_columns(view: str) -> str:
+    """SELECT list for a view; summaries never read more than the preview of the code"""
+    if view == 'summary':
+        code_column = f"left(code, {SUMMARY_PREVIEW_CHARS}) AS preview"
+    else:
+        code_column = "code"
+    return f"id, hash, {code_column}, description, language, tags, usage_count, success_rate, created_at"
+
+def dumps_json(value: Any) -> bytes:
+    """Serialize to JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode()
+
+def block_row_to_dict(row: asyncpg.Record, code_key: str = 'code') -> Dict[str, Any]:
+    """Map a row selected with _block_columns to its API shape (the one place rows are mapped)"""
+    return {
+        'id': str(row['id']),
+        'hash': row['hash'],
+        code_key: row[code_key],
+        'description': row['description'],
+        'language': row['language'],
+        'tags': row['tags'] or [],
+        'usage_count': row['usage_count'],
+        'success_rate': float(row['success_rate']),
+        'created_at': row['created_at'].isoformat(),
+    }
+
+def encode_block_rows(rows: List[asyncpg.Record], view: str = 'full') -> bytes:
+    """Serialize rows straight to the CodeBlockResponse/CodeBlockSummary JSON shape"""
+    code_key = 'preview' if view == 'summary' else 'code'
+    return dumps_json([block_row_to_dict(row, code_key) for row in rows])
+
+def _search_sql(mode: str, language: Optional[str], after: bool = False, view: str = 'full') -> str:
+    """Build the search query for a mode, optionally filtered by language and after a cursor"""
+    source, condition, rank = SEARCH_QUERIES[mode]
+    param_count = 2
+    language_clause = ""
     if language:
-        search_conditions.append(f"language = ${param_count}")
-        params.append(language)
+        language_clause = f"AND language = ${param_count}"
         param_count += 1
+    cursor_clause = ""
+    if after:
+        cursor_clause = f"WHERE (rank, id) < (${param_count}, ${param_count + 1})"
+        param_count += 2
+    return f"""
+        SELECT * FROM (
+            SELECT {_block_columns(view)}, ({rank})::float8 AS rank
+            FROM code_blocks{source}
+            WHERE {condition}
+            {language_clause}
+        ) ranked
+        {cursor_clause}
+        ORDER BY rank DESC, id DESC
+        LIMIT ${param_count}
+    """
+
+# Pure text relevance (no popularity boost) for hybrid candidates; {language_clause}
+# is empty or "AND language = $2"
+_HYBRID_TEXT_SQL = f"""
+    SELECT id, ts_rank_cd(search_vector, query, 32)::float8 AS rank
+    FROM code_blocks, websearch_to_tsquery('{FTS_CONFIG}', $1) AS query
+    WHERE search_vector @@ query {{language_clause}}
+    ORDER BY rank DESC, id DESC
+    LIMIT {HYBRID_CANDIDATES}
+"""
+
+for _language_clause in ("", "AND language = $2"):
+    register_statement(f"hybrid_text:{'language' if _language_clause else 'all'}",
+                       _HYBRID_TEXT_SQL.format(language_clause=_language_clause))
+
+_POPULARITY_BY_IDS = register_statement('popularity_by_ids', """
+    SELECT id, usage_count, success_rate FROM code_blocks WHERE id = ANY($1)
+""")
+
+def fuse_scores(text_hits: List[Tuple[Any, float]], semantic_hits: List[Tuple[Any, float]],
+                popularity: Dict[Any, Tuple[int, float]]) -> Dict[Any, float]:
+    """Combine ranked (id, score) lists with (usage_count, success_rate) per candidate.
     
-    where_clause = "WHERE " + " AND ".join(search_conditions) if search_conditions else ""
+    Only ids in popularity are scored; the weights come from HYBRID_WEIGHTS.
+    """
+    weights = HYBRID_WEIGHTS
+    scores = {block_id: 0.0 for block_id in popularity}
+    if HYBRID_RANKING == 'linear':
+        top_text = max((score for _, score in text_hits), default=0.0) or 1.0
+        for block_id, score in text_hits:
+            if block_id in scores:
+                scores[block_id] += weights['text'] * score / top_text
+        for block_id, score in semantic_hits:
+            if block_id in scores:
+                scores[block_id] += weights['semantic'] * max(score, 0.0)
+        # popularity is empty when no candidate is on this replica yet (or they were deleted)
+        top_usage = math.log1p(max((max(usage, 0) for usage, _ in popularity.values()), default=0)) or 1.0
+        for block_id, (usage, success_rate) in popularity.items():
+            scores[block_id] += (weights['usage'] * math.log1p(max(usage, 0)) / top_usage
+                                 + weights['success'] * success_rate)
+        return scores
     
-    sql = f"""
-        SELECT id, hash, code, description, language, tags, usage_count, 
-               success_rate, created_at
-        FROM code_blocks
-        {where_clause}
-        ORDER BY usage_count DESC, success_rate DESC
-        LIMIT ${param_count}
+    def add_ranks(weight: float, ranked_ids: List[Any]):
+        for rank, block_id in enumerate(ranked_ids, 1):
+            if block_id in scores:
+                scores[block_id] += weight / (HYBRID_RRF_K + rank)
+    
+    add_ranks(weights['text'], [block_id for block_id, _ in text_hits])
+    add_ranks(weights['semantic'], [block_id for block_id, _ in semantic_hits])
+    add_ranks(weights['usage'], sorted(popularity, key=lambda block_id: popularity[block_id][0], reverse=True))
+    add_ranks(weights['success'], sorted(popularity, key=lambda block_id: popularity[block_id][1], reverse=True))
+    return scores
+
+async def hybrid_search(query: str, language: Optional[str] = None, limit: int = 10,
+                        after: Optional[Tuple[float, Any]] = None) -> List[Tuple[Any, float]]:
+    """Rank the union of the top full-text and semantic matches with fuse_scores.
+    
+    Candidate lists are bounded by HYBRID_CANDIDATES, so ranking cost does not
+    grow with the corpus.
     """
-    params.append(limit)
+    async def text_candidates() -> List[Tuple[Any, float]]:
+        if MEMORY_SEARCH and search_index.ready:
+            return search_index.search(query, language, HYBRID_CANDIDATES)
+        async with acquire_connection(replica=True) as conn:
+            if language:
+                rows = await conn.fetch(STATEMENTS['hybrid_text:language'], query, language)
+            else:
+                rows = await conn.fetch(STATEMENTS['hybrid_text:all'], query)
+        return [(row['id'], row['rank']) for row in rows]
     
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch(sql, *params)
+    async def semantic_candidates() -> List[Tuple[Any, float]]:
+        if not vector_index.ready:
+            return []
+        query_embedding = (await compute_embeddings([('', query, [])]))[0]
+        return vector_index.search(query_embedding, language, HYBRID_CANDIDATES)
     
-    blocks = []
-    for row in rows:
-        block = CodeBlockResponse(
-            id=str(row['id']),
-            hash=row['hash'],
-            code=row['code'],
-            description=row['description'],
-            language=row['language'],
-            tags=list(row['tags'] or []),
-            usage_count=row['usage_count'],
-            success_rate=float(row['success_rate']),
-            created_at=row['created_at'].isoformat()
-        )
-        blocks.append(block)
+    text_hits, semantic_hits = await asyncio.gather(text_candidates(), semantic_candidates())
+    candidate_ids = list(dict.fromkeys(block_id for block_id, _ in text_hits + semantic_hits))
+    if not candidate_ids:
+        return []
+    async with acquire_connection(replica=True) as conn:
+        rows = await conn.fetch(STATEMENTS[_POPULARITY_BY_IDS], candidate_ids)
+    popularity = {row['id']: (row['usage_count'], float(row['success_rate'])) for row in rows}
     
-    return blocks
+    ranked = ((score, _cursor_id(block_id), block_id)
+              for block_id, score in fuse_scores(text_hits, semantic_hits, popularity).items())
+    if after is not None:
+        ranked = (item for item in ranked if (item[0], item[1]) < after)
+    top = heapq.nlargest(limit, ranked, key=lambda item: (item[0], item[1]))
+    return [(block_id, score) for score, _, block_id in top]
+
+for _view in VIEWS:
+    register_statement(f'blocks_by_ids:{_view}', f"""
+        SELECT {_block_columns(_view)}
+        FROM code_blocks
+        WHERE id = ANY($1)
+    """)
+    register_statement(f'browse:{_view}', f"""
+        SELECT {_block_columns(_view)}
+        FROM code_blocks
+        ORDER BY created_at DESC, id DESC
+        LIMIT $1
+    """)
+    register_statement(f'browse_after:{_view}', f"""
+        SELECT {_block_columns(_view)}
+        FROM code_blocks
+        WHERE (created_at, id) < ($1, $2)
+        ORDER BY created_at DESC, id DESC
+        LIMIT $3
+    """)
 
-async def get_all_blocks(limit: int = 50) -> List[CodeBlockResponse]:
-    """Get all code blocks"""
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT id, hash, code, description, language, tags, usage_count, 
-                   success_rate, created_at
-            FROM code_blocks
-            ORDER BY created_at DESC
-            LIMIT $1
-        """, limit)
+def search_statement(mode: str, language: Optional[str], after: bool, view: str) -> str:
+    """Registry name of the _search_sql shape for these options"""
+    return f"search:{mode}:{'language' if language else 'all'}:{'after' if after else 'first'}:{view}"
+
+for _mode in SEARCH_QUERIES:
+    for _language in (None, 'language'):
+        for _after in (False, True):
+            for _view in VIEWS:
+                register_statement(search_statement(_mode, _language, _after, _view),
+                                   _search_sql(_mode, _language, _after, _view))
+
+_BLOCK_BY_ID = register_statement('block_by_id', f"""
+    SELECT {_block_columns('full')}
+    FROM code_blocks
+    WHERE id = $1
+""")
+
+async def fetch_blocks_by_ids(block_ids: List[Any], view: str = 'full') -> List[asyncpg.Record]:
+    """Load blocks by primary key, preserving the order of block_ids"""
+    if not block_ids:
+        return []
+    async with acquire_connection(replica=True) as conn:
+        rows = await conn.fetch(STATEMENTS[f'blocks_by_ids:{view}'], block_ids)
+    by_id = {row['id']: row for row in rows}
+    return [by_id[block_id] for block_id in block_ids if block_id in by_id]
+
+async def search_code_blocks(query: str, language: Optional[str] = None, limit: int = 10,
+                             mode: Optional[str] = None, cursor: Optional[str] = None,
+                             view: str = 'full') -> Tuple[List[asyncpg.Record], Optional[str]]:
+    """Search for code blocks, returning one page of rows and the cursor for the next"""
+    mode = mode or SEARCH_MODE
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode}")
     
-    blocks = []
-    for row in rows:
-        block = CodeBlockResponse(
-            id=str(row['id']),
-            hash=row['hash'],
-            code=row['code'],
-            description=row['description'],
-            language=row['language'],
-            tags=list(row['tags'] or []),
-            usage_count=row['usage_count'],
-            success_rate=float(row['success_rate']),
-            created_at=row['created_at'].isoformat()
-        )
-        blocks.append(block)
+    # Queries without any word characters produce an empty tsquery
+    if mode in ('fulltext', 'hybrid') and not re.search(r'\w', query):
+        mode = 'ilike'
+    
+    after = None
+    if cursor:
+        values = decode_cursor(cursor, 'mode', 'rank', 'id')
+        if values['mode'] != mode:
+            raise ValueError("Cursor belongs to a different search mode")
+        after = (values['rank'], values['id'])
+    
+    hits = None
+    if mode == 'hybrid':
+        hits = await hybrid_search(query, language, limit, after)
+    elif mode == 'semantic':
+        if not vector_index.ready:
+            raise RuntimeError("Semantic search index is not available")
+        query_embedding = (await compute_embeddings([('', query, [])]))[0]
+        hits = vector_index.search(query_embedding, language, limit, after)
+    elif mode == 'fulltext' and MEMORY_SEARCH and search_index.ready:
+        hits = search_index.search(query, language, limit, after)
+    
+    if hits is not None:
+        rows = await fetch_blocks_by_ids([block_id for block_id, _ in hits], view)
+        page_full = len(hits) == limit
+        last = (hits[-1][1], hits[-1][0]) if hits else None
+    else:
+        params = [query]
+        if language:
+            params.append(language)
+        if after is not None:
+            params.extend(after)
+        params.append(limit)
+        
+        async with acquire_connection(replica=True) as conn:
+            rows = await conn.fetch(STATEMENTS[search_statement(mode, language, after is not None, view)], *params)
+        page_full = len(rows) == limit
+        last = (rows[-1]['rank'], rows[-1]['id']) if rows else None
+    
+    next_cursor = None
+    if page_full and last is not None:
+        next_cursor = encode_cursor({'mode': mode, 'rank': last[0], 'id': _cursor_id(last[1])})
+    return rows, next_cursor
+
+async def get_block(block_id: str) -> Optional[Dict[str, Any]]:
+    """Get a single code block including its full code (None if no block has that id)"""
+    async with acquire_connection() as conn:
+        try:
+            row = await conn.fetchrow(STATEMENTS[_BLOCK_BY_ID], block_id)
+        except asyncpg.exceptions.DataError:
+            # Not a valid value for the key column (uuid, or int in older databases)
+            return None
+    return block_row_to_dict(row) if row is not None else None
+
+async def get_all_blocks(limit: int = 50, cursor: Optional[str] = None,
+                         view: str = 'full') -> Tuple[List[asyncpg.Record], Optional[str]]:
+    """Get code blocks newest first, returning one page of rows and the cursor for the next"""
+    async with acquire_connection(replica=True) as conn:
+        if cursor:
+            values = decode_cursor(cursor, 'created_at', 'id')
+            rows = await conn.fetch(STATEMENTS[f'browse_after:{view}'],
+                values['created_at'], values['id'], limit)
+        else:
+            rows = await conn.fetch(STATEMENTS[f'browse:{view}'], limit)
+    
+    next_cursor = None
+    if rows and len(rows) == limit:
+        last = rows[-1]
+        next_cursor = encode_cursor({'created_at': last['created_at'].isoformat(), 'id': _cursor_id(last['id'])})
+    return rows, next_cursor
+
+async def rehash_code_blocks(dry_run: bool = False) -> Dict[str, int]:
+    """Recompute every hash with the current normalization/algorithm and merge duplicates.
     
-    return blocks
+    Of each group of blocks that now share a hash the oldest is kept; it
+    absorbs the others' usage counts (plus one per merged copy) and the rest
+    are deleted. Writers are blocked for the duration. Runs on a dedicated
+    connection without a command timeout, like run_migrations, since a full
+    scan of a large table outlasts DB_COMMAND_TIMEOUT.
+    """
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            await conn.execute("LOCK TABLE code_blocks IN SHARE ROW EXCLUSIVE MODE")
+            await conn.execute("""
+                CREATE TEMP TABLE code_blocks_rehash ON COMMIT DROP AS
+                SELECT id, hash FROM code_blocks WITH NO DATA
+            """)
+            
+            scanned = 0
+            batch = []
+            async for row in conn.cursor("SELECT id, hash, code, language FROM code_blocks"):
+                new_hash = hash_code(row['code'], row['language'])
+                scanned += 1
+                if new_hash != row['hash']:
+                    batch.append((row['id'], new_hash))
+                if len(batch) >= 10000:
+                    await conn.copy_records_to_table('code_blocks_rehash', records=batch)
+                    batch.clear()
+            if batch:
+                await conn.copy_records_to_table('code_blocks_rehash', records=batch)
+            
+            # Every block's hash after the migration, for grouping
+            await conn.execute("""
+                CREATE TEMP TABLE code_blocks_rehash_groups ON COMMIT DROP AS
+                SELECT b.id, coalesce(r.hash, b.hash) AS hash, b.usage_count,
+                       first_value(b.id) OVER (
+                           PARTITION BY coalesce(r.hash, b.hash) ORDER BY b.created_at, b.id
+                       ) AS keep_id
+                FROM code_blocks b
+                LEFT JOIN code_blocks_rehash r ON r.id = b.id
+            """)
+            await conn.execute("""
+                UPDATE code_blocks SET usage_count = code_blocks.usage_count + extra.hits
+                FROM (
+                    SELECT keep_id, sum(usage_count + 1) AS hits
+                    FROM code_blocks_rehash_groups
+                    WHERE id <> keep_id
+                    GROUP BY keep_id
+                ) extra
+                WHERE code_blocks.id = extra.keep_id
+            """)
+            # Merged rows reach the in-process indexes through code_block_deletions;
+            # entries this old have been seen by every refresher
+            await conn.execute("DELETE FROM code_block_deletions WHERE deleted_at < now() - interval '7 days'")
+            merged = await conn.fetchval("""
+                WITH deleted AS (
+                    DELETE FROM code_blocks USING code_blocks_rehash_groups g
+                    WHERE code_blocks.id = g.id AND g.id <> g.keep_id
+                    RETURNING 1
+                )
+                SELECT count(*) FROM deleted
+            """)
+            rehashed = await conn.fetchval("""
+                WITH updated AS (
+                    UPDATE code_blocks SET hash = r.hash
+                    FROM code_blocks_rehash r
+                    WHERE code_blocks.id = r.id
+                    RETURNING 1
+                )
+                SELECT count(*) FROM updated
+            """)
+        except BaseException:
+            await transaction.rollback()
+            raise
+        if dry_run:
+            await transaction.rollback()
+        else:
+            await transaction.commit()
+    finally:
+        await conn.close()
+    return {"scanned": scanned, "rehashed": rehashed, "merged": merged}
+
+async def run_rehash(dry_run: bool):
+    """Entry point for `python code_block_manager.py rehash [--dry-run]`"""
+    await run_migrations()
+    result = await rehash_code_blocks(dry_run)
+    mode = "dry run, rolled back" if dry_run else "committed"
+    print(f"Rehashed {result['rehashed']} of {result['scanned']} blocks, "
+          f"merged {result['merged']} duplicates ({HASH_ALGORITHM}, {mode})")
 
 # Web interface HTML
 def get_html_interface():
@@ -559,8 +2791,9 @@ def get_html_interface():
         <!-- Browse Tab -->
         <div id="browse-tab" class="content hidden">
             <h2>Browse All Code Blocks</h2>
-            <button onclick="loadAllBlocks()" class="btn">📚 Load All Blocks</button>
+            <button onclick="loadAllBlocks(false)" class="btn">📚 Load All Blocks</button>
             <div id="browse-results"></div>
+            <button id="browse-more" onclick="loadAllBlocks(true)" class="btn hidden">⬇️ Load More</button>
         </div>
     </div>
 
@@ -602,7 +2835,7 @@ def get_html_interface():
                 
                 if (response.ok) {
                     const result = await response.json();
-                    showMessage('add-message', `✅ Code block stored successfully! ID: ${result.id}`, 'success');
+                    showMessage('add-message', `✅ ${result.message}! ID: ${result.id}`, 'success');
                     e.target.reset();
                 } else {
                     const error = await response.json();
@@ -641,25 +2874,37 @@ def get_html_interface():
             }
         }
 
-        async function loadAllBlocks() {
+        let browseCursor = null;
+
+        async function loadAllBlocks(append = false) {
             const resultsEl = document.getElementById('browse-results');
-            resultsEl.innerHTML = '<div class="loading">Loading all blocks...</div>';
+            const moreEl = document.getElementById('browse-more');
+            if (!append) {
+                browseCursor = null;
+                resultsEl.innerHTML = '<div class="loading">Loading all blocks...</div>';
+            }
             
             try {
-                const response = await fetch('/api/blocks');
+                const params = new URLSearchParams();
+                if (browseCursor) params.append('cursor', browseCursor);
+                const response = await fetch(`/api/blocks?${params}`);
                 const blocks = await response.json();
                 
-                displayBlocks(blocks, 'browse-results');
+                browseCursor = response.headers.get('X-Next-Cursor');
+                displayBlocks(blocks, 'browse-results', append);
+                moreEl.classList.toggle('hidden', !browseCursor);
             } catch (error) {
                 resultsEl.innerHTML = `<div class="message error">❌ Load error: ${error.message}</div>`;
             }
         }
 
-        function displayBlocks(blocks, containerId) {
+        function displayBlocks(blocks, containerId, append = false) {
             const container = document.getElementById(containerId);
             
             if (!blocks || blocks.length === 0) {
-                container.innerHTML = '<div class="message">No code blocks found.</div>';
+                if (!append) {
+                    container.innerHTML = '<div class="message">No code blocks found.</div>';
+                }
                 return;
             }
             
@@ -682,7 +2927,11 @@ def get_html_interface():
                 </div>
             `).join('');
             
-            container.innerHTML = html;
+            if (append) {
+                container.insertAdjacentHTML('beforeend', html);
+            } else {
+                container.innerHTML = html;
+            }
         }
 
         function escapeHtml(text) {
@@ -702,13 +2951,94 @@ def get_html_interface():
 </html>
 """
 
+async def refresh_stats():
+    """Recompute the per-language statistics (one replica at a time)"""
+    async with acquire_connection() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", STATS_REFRESH_LOCK_ID):
+            return
+        try:
+            await conn.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY code_block_language_stats")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", STATS_REFRESH_LOCK_ID)
+
+async def run_stats_refresher():
+    """Refresh statistics periodically"""
+    while True:
+        await asyncio.sleep(STATS_REFRESH_SECONDS)
+        try:
+            await refresh_stats()
+        except Exception as e:
+            print(f"Stats refresh failed: {e}")
+
+# Background tasks started with the app
+background_tasks: List[asyncio.Task] = []
+
+class ReadYourWritesMiddleware:
+    """Route a client's reads to the primary for READ_YOUR_WRITES_SECONDS after
+    it stores blocks, so its own writes are visible despite replica lag"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not replicas:
+            await self.app(scope, receive, send)
+            return
+        
+        try:
+            wrote_at = float(HTTPConnection(scope).cookies.get(WRITE_COOKIE, 0))
+        except ValueError:
+            wrote_at = 0.0
+        is_write = scope['method'] == 'POST' and scope['path'].startswith('/api/blocks')
+        
+        async def send_with_cookie(message):
+            if is_write and message['type'] == 'http.response.start' and message['status'] < 400:
+                headers = MutableHeaders(scope=message)
+                headers.append('set-cookie', f"{WRITE_COOKIE}={time.time():.3f}; Max-Age="
+                               f"{math.ceil(READ_YOUR_WRITES_SECONDS)}; Path=/; HttpOnly; SameSite=Lax")
+            await send(message)
+        
+        token = read_from_primary.set(time.time() - wrote_at < READ_YOUR_WRITES_SECONDS)
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            read_from_primary.reset(token)
+
+app.add_middleware(ReadYourWritesMiddleware)
+
 # API Routes
 @app.on_event("startup")
 async def startup():
+    await run_migrations(MIGRATE_ON_STARTUP_MAX_ROWS)
     await init_db()
+    await asyncio.gather(*(check_replica(replica) for replica in replicas))
+    init_analysis_executor()
+    background_tasks.append(asyncio.create_task(run_stats_refresher()))
+    background_tasks.append(asyncio.create_task(run_usage_flusher()))
+    if replicas:
+        background_tasks.append(asyncio.create_task(run_replica_health_checker()))
+    if MEMORY_SEARCH:
+        background_tasks.append(asyncio.create_task(run_index_refresher(refresh_search_index, "Search index")))
+    elif SEARCH_BACKEND == 'memory':
+        print("In-memory search disabled: the 'numpy' package is not installed")
+    if NEAR_DUP_POLICY != 'off':
+        background_tasks.append(asyncio.create_task(
+            run_index_refresher(refresh_near_duplicate_index, "Near-duplicate index")))
+    if SEMANTIC_SEARCH:
+        background_tasks.append(asyncio.create_task(run_index_refresher(refresh_vector_index, "Vector index")))
+    elif EMBEDDING_MODEL != 'off':
+        print("Semantic search disabled: the 'numpy' package is not installed")
 
 @app.on_event("shutdown")
 async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    try:
+        await usage_buffer.flush()
+    except Exception as e:
+        print(f"Final usage count flush failed, {usage_buffer.pending_total} increments lost: {e}")
+    close_analysis_executor()
     await close_db()
 
 @app.get("/", response_class=HTMLResponse)
@@ -720,60 +3050,229 @@ async def get_interface():
 async def create_block(block: CodeBlockCreate):
     """Create a new code block"""
     try:
-        block_id = await store_code_block(block)
-        return {"id": block_id, "message": "Code block stored successfully"}
+        block_id, created, near_duplicates = await store_code_block(block)
+        similar = [{"id": similar_id, "similarity": similarity} for similar_id, similarity in near_duplicates]
+        if created:
+            return {"id": block_id, "created": True, "near_duplicates": similar,
+                    "message": "Code block stored successfully"}
+        return {"id": block_id, "created": False, "near_duplicates": similar,
+                "message": "Code block already exists; usage count updated"}
+    except Exception as e:
+        raise server_error(e)
+
+@app.post("/api/blocks/bulk")
+async def create_blocks_bulk(request: Request):
+    """Create code blocks from a JSON array or an NDJSON body"""
+    body = await request.body()
+    try:
+        if 'ndjson' in request.headers.get('content-type', ''):
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of code blocks")
+    if len(items) > BULK_MAX_BLOCKS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_BLOCKS} blocks per request")
+    
+    blocks = []
+    for index, item in enumerate(items):
+        try:
+            blocks.append(CodeBlockCreate(**item))
+        except (TypeError, ValidationError) as e:
+            raise HTTPException(status_code=422, detail=f"Block {index}: {e}")
+    if not blocks:
+        return {"results": [], "inserted": 0, "duplicates": 0}
+    
+    try:
+        results = await store_code_blocks(blocks)
+        inserted = sum(1 for _, created in results if created)
+        return {
+            "results": [{"id": block_id, "created": created} for block_id, created in results],
+            "inserted": inserted,
+            "duplicates": len(results) - inserted
+        }
+    except Exception as e:
+        raise server_error(e)
+
+@app.post("/api/blocks/stream")
+async def create_blocks_stream(request: Request, job: Optional[str] = None):
+    """Ingest an NDJSON upload of any size without buffering it"""
+    job_id = job or uuid.uuid4().hex
+    progress = {
+        "job_id": job_id, "status": "running", "bytes": 0, "lines": 0,
+        "inserted": 0, "duplicates": 0, "errors": 0, "error_samples": [],
+        "started_at": datetime.utcnow().isoformat(), "updated_at": None
+    }
+    ingest_jobs[job_id] = progress
+    while len(ingest_jobs) > INGEST_JOBS_KEPT:
+        ingest_jobs.popitem(last=False)
+    
+    try:
+        await ingest_ndjson_stream(request.stream(), progress)
+        progress['status'] = "done"
+        return progress
+    except ValueError as e:
+        progress['status'] = "failed"
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        progress['status'] = "failed"
+        raise server_error(e)
+
+@app.get("/api/ingest/{job_id}")
+async def get_ingest_progress(job_id: str):
+    """Report progress of a streaming ingestion"""
+    progress = ingest_jobs.get(job_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Unknown ingestion job")
+    return progress
+
+@app.get("/api/blocks", response_model=List[Union[CodeBlockResponse, CodeBlockSummary]])
+async def get_blocks(limit: int = 50, cursor: Optional[str] = None, view: str = 'full'):
+    """Get all code blocks (next page cursor in the X-Next-Cursor header)"""
+    if view not in VIEWS:
+        raise HTTPException(status_code=400, detail=f"view must be one of: {', '.join(VIEWS)}")
+    try:
+        rows, next_cursor = await get_all_blocks(limit, cursor, view)
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else None
+        return Response(content=encode_block_rows(rows, view), media_type='application/json', headers=headers)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise server_error(e)
 
-@app.get("/api/blocks")
-async def get_blocks(limit: int = 50):
-    """Get all code blocks"""
+@app.get("/api/blocks/{block_id}", response_model=CodeBlockResponse)
+async def get_block_endpoint(block_id: str):
+    """Get a single code block with its full code"""
     try:
-        blocks = await get_all_blocks(limit)
-        return blocks
+        block = await get_block(block_id)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise server_error(e)
+    if block is None:
+        raise HTTPException(status_code=404, detail="Code block not found")
+    return Response(content=dumps_json(block), media_type='application/json')
 
-@app.get("/api/search")
-async def search_blocks_endpoint(q: str, language: Optional[str] = None, limit: int = 10):
-    """Search code blocks"""
+@app.get("/api/blocks/{block_id}/similar", response_model=List[CodeBlockSummary])
+async def get_similar_blocks(block_id: str, limit: int = 10, threshold: Optional[float] = None):
+    """Get near-duplicates of a block (each with a 'similarity' field)"""
+    if not near_duplicate_index.ready:
+        raise HTTPException(status_code=503, detail="Near-duplicate index is not available")
+    signature = near_duplicate_index.signature_of(block_id)
+    if signature is None:
+        raise HTTPException(status_code=404, detail="Code block not found")
+    
+    matches = near_duplicate_index.query(signature, threshold if threshold is not None else NEAR_DUP_THRESHOLD,
+                                         limit, exclude=block_id)
+    try:
+        rows = await fetch_blocks_by_ids([similar_id for similar_id, _ in matches], 'summary')
+    except Exception as e:
+        raise server_error(e)
+    similarities = {str(similar_id): similarity for similar_id, similarity in matches}
+    blocks = []
+    for row in rows:
+        block = block_row_to_dict(row, 'preview')
+        block['similarity'] = similarities[block['id']]
+        blocks.append(block)
+    return Response(content=dumps_json(blocks), media_type='application/json')
+
+@app.get("/api/search", response_model=List[Union[CodeBlockResponse, CodeBlockSummary]])
+async def search_blocks_endpoint(q: str, language: Optional[str] = None, limit: int = 10,
+                                 mode: Optional[str] = None, cursor: Optional[str] = None,
+                                 view: str = 'full'):
+    """Search code blocks (next page cursor in the X-Next-Cursor header)"""
+    if mode and mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(SEARCH_MODES)}")
+    if view not in VIEWS:
+        raise HTTPException(status_code=400, detail=f"view must be one of: {', '.join(VIEWS)}")
+    if (mode or SEARCH_MODE) == 'semantic' and not vector_index.ready:
+        raise HTTPException(status_code=503, detail="Semantic search index is not available")
+    key = search_cache_key(q, language, limit, mode or SEARCH_MODE, cursor, view)
+    try:
+        # A client that just stored a block may have been served a page cached before its write
+        cached = None if read_from_primary.get() else await search_cache.get(key)
+        if cached is None:
+            generation, invalidated_at = await search_cache.snapshot()
+            rows, next_cursor = await search_code_blocks(q, language, limit, mode, cursor, view)
+            body = encode_block_rows(rows, view)
+            # Stored as "<next cursor>\n<body>"; cursors are base64url so never contain a newline
+            cached = (next_cursor or '').encode() + b'\n' + body
+            # A replica may not have replayed the write behind a recent
+            # invalidation yet; caching its page would serve it for the whole TTL
+            from_replica = not read_from_primary.get() and any(replica.healthy for replica in replicas)
+            if not from_replica or time.time() - invalidated_at >= READ_YOUR_WRITES_SECONDS:
+                await search_cache.set(key, cached, generation)
+        next_cursor, _, body = cached.partition(b'\n')
+        headers = {'X-Next-Cursor': next_cursor.decode()} if next_cursor else None
+        return Response(content=body, media_type='application/json', headers=headers)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise server_error(e)
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness probe: the process is up (no database access)"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness probe: a pooled connection answers SELECT 1 within the deadline"""
+    metrics = pool_stats.metrics(db_pool)
+    pool = {key: metrics[key] for key in ("size", "idle", "max_size", "in_use", "saturation", "waiting")}
+    
     try:
-        blocks = await search_code_blocks(q, language, limit)
-        return blocks
+        if db_pool is None:
+            raise RuntimeError("Database pool not initialized")
+        async with db_pool.acquire(timeout=READY_TIMEOUT_SECONDS) as conn:
+            await conn.fetchval("SELECT 1", timeout=READY_TIMEOUT_SECONDS)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        return JSONResponse(status_code=503, content={"status": "unavailable", "error": str(e) or type(e).__name__, "pool": pool})
+    return {"status": "ready", "pool": pool}
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """Get in-process performance counters"""
+    return {
+        "db_pool": pool_stats.metrics(db_pool),
+        "replicas": [replica.metrics() for replica in replicas],
+        "search_cache": search_cache.metrics(),
+        "usage_buffer": usage_buffer.metrics(),
+        "semantic_index": vector_index.metrics(),
+    }
+
+_LANGUAGE_STATS = register_statement('language_stats', """
+    SELECT language, block_count, usage_sum, success_sum, refreshed_at
+    FROM code_block_language_stats
+    ORDER BY block_count DESC
+""")
 
 @app.get("/api/stats")
 async def get_stats():
-    """Get system statistics"""
+    """Get system statistics (refreshed every STATS_REFRESH_SECONDS)"""
     try:
-        async with db_pool.acquire() as conn:
-            stats = await conn.fetchrow("""
-                SELECT 
-                    COUNT(*) as total_blocks,
-                    COUNT(DISTINCT language) as languages,
-                    AVG(usage_count) as avg_usage,
-                    AVG(success_rate) as avg_success_rate
-                FROM code_blocks
-            """)
-            
-            top_languages = await conn.fetch("""
-                SELECT language, COUNT(*) as count
-                FROM code_blocks
-                GROUP BY language
-                ORDER BY count DESC
-                LIMIT 5
-            """)
-            
-            return {
-                "total_blocks": stats['total_blocks'],
-                "languages": stats['languages'],
-                "avg_usage": float(stats['avg_usage'] or 0),
-                "avg_success_rate": float(stats['avg_success_rate'] or 0),
-                "top_languages": {row['language']: row['count'] for row in top_languages}
-            }
+        async with acquire_connection(replica=True) as conn:
+            rows = await conn.fetch(STATEMENTS[_LANGUAGE_STATS])
+        
+        total_blocks = sum(row['block_count'] for row in rows)
+        refreshed_at = min((row['refreshed_at'] for row in rows), default=None)
+        return {
+            "total_blocks": total_blocks,
+            "languages": len(rows),
+            "avg_usage": float(sum(row['usage_sum'] for row in rows) / total_blocks) if total_blocks else 0.0,
+            "avg_success_rate": float(sum(row['success_sum'] for row in rows) / total_blocks) if total_blocks else 0.0,
+            "top_languages": {row['language']: row['block_count'] for row in rows[:5]},
+            "refreshed_at": refreshed_at.isoformat() if refreshed_at else None,
+            "stale_seconds": (datetime.now(timezone.utc) - refreshed_at).total_seconds() if refreshed_at else None
+        }
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise server_error(e)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if sys.argv[1:2] == ['rehash']:
+        asyncio.run(run_rehash(dry_run='--dry-run' in sys.argv[2:]))
+    elif sys.argv[1:2] == ['migrate']:
+        applied = asyncio.run(run_migrations())
+        print(f"Applied migrations: {', '.join(map(str, applied))}" if applied else "Schema is up to date")
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)